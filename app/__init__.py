@@ -1,4 +1,5 @@
 import logging
+from pathlib import Path
 
 from flask import Flask
 
@@ -11,12 +12,35 @@ def create_app(test_config=None):
 
     # configs
     app.config.from_mapping(
-        SECRET_KEY='dev'
+        SECRET_KEY='dev',
+        ANNOY_PRELOAD=False,
+        SIMILARITY_SEARCH_K=-1,
+        SIMILARITY_MAX_ROUNDS=8,
+        PROJECTION_CACHE_SIZE=2**30,
+        JOBS_WORKERS=2,
+        PLOT_COLUMNAR_THRESHOLD=200,
+        PROJECTION_FIT_SAMPLE=100000,
+        EXTRACT_DECODE_WORKERS=4,
+        EXTRACT_WRITE_WORKERS=1,
+        EXTRACT_BATCH_PATCHES=512,
+        EXTRACT_MAX_PATCHES=512,
+        EXTRACT_QUEUE_SIZE=16,
+        INDEX_WORKERS=2,
+        ID3_WORKERS=4,
+        JAMENDO_API_URL='https://api.jamendo.com/v3.0',
+        JAMENDO_WORKERS=4,
+        JAMENDO_RATE_LIMIT=5,
+        EMBEDDINGS_READ_WORKERS=8,
+        EMBEDDINGS_READ_AHEAD=32
     )
     if test_config is None:
         app.config.from_pyfile('config.py', silent=True)
     else:
         app.config.from_mapping(test_config)
+    app.config.setdefault('PROJECTION_CACHE_DIR', str(Path(app.instance_path) / 'projections'))
+    app.config.setdefault('JOBS_DIR', str(Path(app.instance_path) / 'jobs'))
+    app.config.setdefault('PROJECTION_MODELS_DIR', str(Path(app.instance_path) / 'projection-models'))
+    app.config.setdefault('STAMPS_DIR', str(Path(app.instance_path) / 'stamps'))
 
     # config our logging
     logging_level = getattr(logging, app.config['LOGGING_LEVEL'])
@@ -47,11 +71,18 @@ def create_app(test_config=None):
     experiments.init_app(app)
 
     # blueprints
-    from . import models, plot, providers, similarity, views
+    from . import jobs, models, plot, providers, similarity, views
     app.register_blueprint(views.bp)
     app.register_blueprint(plot.bp)
     app.register_blueprint(providers.bp)
     app.register_blueprint(models.bp)
     app.register_blueprint(similarity.bp)
+    app.register_blueprint(jobs.bp)
+
+    # load annoy indexes before uWSGI forks the workers, so they share the memory
+    if app.config['ANNOY_PRELOAD']:
+        from .indexes import index_pool
+        with app.app_context():
+            index_pool.preload(models.get_models().get_all_offline())
 
     return app
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from flask import current_app
+
+
+def concatenate_ranges(starts: np.ndarray, stops: np.ndarray, step: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """Returns indices of all ranges [start, stop) with step concatenated into one array, and lengths of the ranges"""
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    lengths = np.maximum(-((starts - stops) // step), 0)  # ceil division
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    indices = np.repeat(starts, lengths) + (np.arange(lengths.sum()) - offsets) * step
+    return indices, lengths
+
+
+class AggrdataRegistry:
+    """
+    Process-wide registry of memory-mapped aggregated embeddings from AGGRDATA_DIR, keyed by model name. Each file is
+    mapped once and remapped only when the file is replaced on disk (detected by inode and mtime)
+    """
+    def __init__(self):
+        self._arrays: dict[str, tuple[tuple, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_signature(stat: os.stat_result) -> tuple:
+        return stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _map(path: Path) -> tuple[tuple, np.ndarray]:
+        """Maps the .npy file, signature is taken from the same file descriptor, so it always matches the data"""
+        with path.open('rb') as fp:
+            signature = AggrdataRegistry._get_signature(os.fstat(fp.fileno()))
+            if np.lib.format.read_magic(fp) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+            array = np.memmap(fp, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C',
+                              offset=fp.tell())
+        return signature, array
+
+    def get(self, name: str) -> np.ndarray:
+        """
+        Returns memory-mapped embeddings of the model
+        :raises FileNotFoundError: there is no aggregated file for the model
+        """
+        path = Path(current_app.config['AGGRDATA_DIR']) / f'{name}.npy'
+        signature = self._get_signature(path.stat())
+
+        entry = self._arrays.get(name)
+        if entry is None or entry[0] != signature:
+            with self._lock:
+                entry = self._arrays.get(name)
+                if entry is None or entry[0] != signature:
+                    logging.info(f'Mapping {path}')
+                    entry = self._map(path)
+                    self._arrays[name] = entry  # replaced as a whole, readers keep using the old mapping
+        return entry[1]
+
+    def gather(self, name: str, starts: np.ndarray, stops: np.ndarray, step: int = 1,
+               dimensions: Optional[Union[slice, list]] = None) -> list[np.ndarray]:
+        """Reads segments [start, stop) with step for many tracks with one fancy-index gather, and splits them back"""
+        indices, lengths = concatenate_ranges(starts, stops, step)
+        if len(lengths) == 0:
+            return []
+        embeddings = self.get(name)[indices]
+        if dimensions is not None:
+            embeddings = embeddings[:, dimensions]
+        return np.split(embeddings, np.cumsum(lengths)[:-1])
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+
+
+aggrdata = AggrdataRegistry()
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import logging
+import os
+import tempfile
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -9,10 +11,13 @@ import numpy as np
 from flask import current_app
 from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, ForeignKey, Integer, String, and_
+from sqlalchemy import Column, ForeignKey, Integer, String, Table, inspect
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
+from ..aggrdata import concatenate_ranges
+from ..prefetch import load_embeddings
+
 db = SQLAlchemy()
 
 
@@ -20,6 +25,44 @@ def needs_committing(session_size):
     return session_size >= current_app.config['DB_COMMIT_BATCH_SIZE']
 
 
+def get_stamp(name: str) -> tuple[int, int]:
+    """
+    Returns version stamp of the data that processes keep in memory, it changes every time touch_stamp is called for the
+    name in any process
+    """
+    try:
+        stat = (Path(current_app.config['STAMPS_DIR']) / name).stat()
+    except FileNotFoundError:
+        return 0, 0
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def touch_stamp(name: str):
+    """
+    Marks the data as modified, should be called after the changes are committed so that all processes (including the
+    web workers) reload the data. The stamp file is replaced with a new one, so that the stamp changes even if the
+    modification time stays the same
+    """
+    stamps_dir = Path(current_app.config['STAMPS_DIR'])
+    stamps_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=stamps_dir, prefix=f'{name}.')
+    os.close(fd)
+    os.replace(tmp_file, stamps_dir / name)
+
+
+def bulk_insert(target, mappings: list[dict]):
+    """Inserts rows into the model or association table in batches of DB_COMMIT_BATCH_SIZE, one executemany per
+    batch without creating ORM objects"""
+    batch_size = current_app.config['DB_COMMIT_BATCH_SIZE']
+    for pos in range(0, len(mappings), batch_size):
+        batch = mappings[pos:pos + batch_size]
+        if isinstance(target, Table):
+            db.session.execute(target.insert(), batch)
+        else:
+            db.session.bulk_insert_mappings(target, batch)
+        db.session.commit()
+
+
 class CommonMixin:
     """
     Has primary key id, and methods get_by_id and get_all
@@ -34,9 +77,13 @@ class CommonMixin:
     def get_by_ids(cls, _ids: list):
         return db.session.query(cls).filter(cls.id.in_(_ids))
 
+    @classmethod
+    def query_all(cls):
+        return db.session.query(cls)
+
     @classmethod
     def get_all(cls, limit=None, random=False):
-        query = db.session.query(cls)
+        query = cls.query_all()
 
         if random:
             query = query.order_by(func.random())
@@ -61,12 +108,21 @@ class Track(CommonMixin, db.Model):
     def __repr__(self):
         return f'Track(id={self.id}, path={self.path})'
 
+    @classmethod
+    def query_all(cls):
+        """Tracks that failed extraction have no embeddings, so they are skipped everywhere except extract-all"""
+        from .manifest import Extraction
+        failed = db.session.query(Extraction.id).filter(Extraction.id == cls.id, Extraction.status == Extraction.FAILED)
+        return db.session.query(cls).filter(~failed.exists())
+
     # segmentations
 
     def has_segmentation(self, length):
         return self._get_segmentation(length) is not None
 
     def _get_segmentation(self, length):
+        if 'segmentations' not in inspect(self).unloaded:  # eagerly loaded, e.g. by TrackCatalog
+            return next((s for s in self.segmentations if s.length == length), None)
         return db.session.query(Segmentation).filter_by(id=self.id, length=length).first()
 
     def get_segments(self, length, sparse_factor=1):
@@ -78,8 +134,7 @@ class Track(CommonMixin, db.Model):
         return Path(self.path).with_suffix('.npy')
 
     def get_embeddings_from_file(self, embeddings_dir) -> np.ndarray:
-        path = Path(embeddings_dir) / self.get_embeddings_filename()
-        return np.load(str(path)).astype(np.float16)
+        return load_embeddings(Path(embeddings_dir) / self.get_embeddings_filename())
 
     def get_aggrdata_slice(self, length, sparse_factor) -> slice:
         s = self._get_segmentation(length)
@@ -129,7 +184,11 @@ class Segment:
 
     @staticmethod
     def get_by_id(segment_length: int, segment_id: int):
-        return Segmentation.get_by_segment_id(segment_length, segment_id).get_segment(segment_id)
+        return get_segment_resolver(segment_length).get_segment(segment_id)
+
+    @staticmethod
+    def get_by_ids(segment_length: int, segment_ids) -> list[Segment]:
+        return get_segment_resolver(segment_length).get_segments(segment_ids)
 
     @property
     def track(self):
@@ -164,19 +223,173 @@ class Segmentation(CommonMixin, db.Model):
 
     @staticmethod
     def get_by_segment_id(segment_length: int, segment_id: int):
-        return db.session.query(Segmentation).filter(and_(Segmentation.length == segment_length,
-                                                          Segmentation.start_id <= segment_id,
-                                                          Segmentation.stop_id > segment_id)).first()
+        track_id = get_segment_resolver(segment_length).get_segment(segment_id).track_id
+        return db.session.get(Segmentation, (track_id, segment_length))
 
     @staticmethod
     def get_total_segments(segment_length):
-        return db.session.query(func.max(Segmentation.stop_id)).filter(
-            Segmentation.length == segment_length).first()[0]
+        return get_segment_resolver(segment_length).total
 
     def get_slice(self, sparse_factor) -> slice:
         return slice(self.start_id, self.stop_id, sparse_factor)
 
 
+class SegmentResolver:
+    """
+    Maps segment ids to tracks for one segment length without touching the database. Keeps the segmentation table as
+    arrays sorted by start_id, so a batch of segment ids is resolved with one searchsorted call
+    """
+    def __init__(self, length: int, start_ids: np.ndarray, stop_ids: np.ndarray, track_ids: np.ndarray):
+        self.length = length
+        self.start_ids = start_ids
+        self.stop_ids = stop_ids
+        self.track_ids = track_ids
+        self._track_order = np.argsort(track_ids)
+        self._artist_ids = None
+        self._artist_ids_stamp = None
+
+    @classmethod
+    def from_db(cls, length: int):
+        rows = db.session.query(Segmentation.start_id, Segmentation.stop_id, Segmentation.id).filter(
+            Segmentation.length == length).order_by(Segmentation.start_id).all()
+        start_ids, stop_ids, track_ids = np.array(rows, dtype=np.int64).reshape(-1, 3).T
+        return cls(length, np.ascontiguousarray(start_ids), np.ascontiguousarray(stop_ids),
+                   np.ascontiguousarray(track_ids))
+
+    def __len__(self):
+        return len(self.start_ids)
+
+    @property
+    def total(self) -> int:
+        """Total number of segments, which is also the next free segment id"""
+        return int(self.stop_ids[-1]) if len(self) > 0 else 0
+
+    def _get_rows(self, segment_ids: np.ndarray) -> np.ndarray:
+        """
+        Returns indices of the segmentations that contain segment_ids
+        :raises KeyError: some of the segment_ids don't belong to any segmentation
+        """
+        rows = np.searchsorted(self.start_ids, segment_ids, side='right') - 1
+        if len(self) == 0:
+            invalid = np.ones(len(segment_ids), dtype=bool)
+        else:
+            invalid = (rows < 0) | (segment_ids >= self.stop_ids[rows])
+        if invalid.any():
+            raise KeyError(f'No segmentation of length {self.length} for segment ids {segment_ids[invalid]}')
+        return rows
+
+    def resolve(self, segment_ids) -> tuple[np.ndarray, np.ndarray]:
+        """Returns track_ids and positions of the segments inside those tracks"""
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        rows = self._get_rows(segment_ids)
+        return self.track_ids[rows], segment_ids - self.start_ids[rows]
+
+    def get_ranges(self, track_ids) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns start_ids and stop_ids of segments for each of the tracks
+        :raises KeyError: some of the tracks don't have segmentation
+        """
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        positions = np.searchsorted(self.track_ids, track_ids, sorter=self._track_order)
+        found = positions < len(self)
+        rows = self._track_order[positions[found]]
+        found[found] = self.track_ids[rows] == track_ids[found]
+        if not found.all():
+            raise KeyError(f'No segmentation of length {self.length} for tracks {track_ids[~found]}')
+        return self.start_ids[rows], self.stop_ids[rows]
+
+    @property
+    def artist_ids(self) -> np.ndarray:
+        """
+        Array that maps every segment id to the artist_id of its track (-1 if unknown), loaded on first use and reloaded
+        when the metadata is modified
+        """
+        stamp = get_stamp('metadata')
+        if self._artist_ids is None or self._artist_ids_stamp != stamp:
+            from .metadata import TrackMetadata  # metadata module depends on this one
+
+            self._artist_ids_stamp = stamp
+            artists = dict(db.session.query(TrackMetadata.id, TrackMetadata.artist_id).all())
+            track_artists = np.array([artists.get(track_id) or -1 for track_id in self.track_ids.tolist()],
+                                     dtype=np.int32)
+            indices, lengths = concatenate_ranges(self.start_ids, self.stop_ids)
+            self._artist_ids = np.full(self.total, -1, dtype=np.int32)
+            self._artist_ids[indices] = np.repeat(track_artists, lengths)
+        return self._artist_ids
+
+    def sort_tracks(self, tracks: list[Track]) -> list[Track]:
+        """Sorts tracks by their segment ids, tracks without segmentation go last ordered by id"""
+        order = {track_id: i for i, track_id in enumerate(self.track_ids.tolist())}
+        return sorted(tracks, key=lambda track: (order.get(track.id, len(order)), track.id))
+
+    def get_segments(self, segment_ids) -> list[Segment]:
+        segment_ids = np.asarray(segment_ids, dtype=np.int64)
+        track_ids, positions = self.resolve(segment_ids)
+        return [Segment(segment_id, self.length, position, track_id) for segment_id, position, track_id in
+                zip(segment_ids.tolist(), positions.tolist(), track_ids.tolist())]
+
+    def get_segment(self, segment_id: int) -> Segment:
+        return self.get_segments([segment_id])[0]
+
+
+_segment_resolvers: dict[int, tuple[tuple[int, int], SegmentResolver]] = {}
+
+
+def get_segment_resolver(length: int) -> SegmentResolver:
+    """
+    Returns process-wide resolver for the segment length, it is built on the first use and rebuilt when the segmentation
+    table was modified by any process since then
+    """
+    stamp = get_stamp('segmentation')  # before the query, so that changes committed during it trigger another rebuild
+    cached = _segment_resolvers.get(length)
+    if cached is None or cached[0] != stamp:
+        cached = _segment_resolvers[length] = stamp, SegmentResolver.from_db(length)
+    return cached[1]
+
+
+def reset_segment_resolvers():
+    """Should be called after changes of the segmentation table are committed, so the resolvers are rebuilt in all
+    processes"""
+    touch_stamp('segmentation')
+
+
+def compact_segmentations():
+    """Shifts segment ids of the remaining segmentations, so that they are contiguous again"""
+    lengths = [length for length, in db.session.query(Segmentation.length).distinct()]
+    for length in lengths:
+        rows = db.session.query(Segmentation.id, Segmentation.start_id, Segmentation.stop_id).filter(
+            Segmentation.length == length).order_by(Segmentation.start_id).all()
+        next_id = 0
+        mappings = []
+        for track_id, start_id, stop_id in rows:
+            if start_id != next_id:
+                mappings.append({'id': track_id, 'length': length, 'start_id': next_id,
+                                 'stop_id': next_id + stop_id - start_id})
+            next_id += stop_id - start_id
+        db.session.bulk_update_mappings(Segmentation, mappings)
+    db.session.commit()
+    reset_segment_resolvers()
+
+
+def remove_stale_segmentations(length: int, n_segments: dict[int, int]) -> list[int]:
+    """
+    Removes segmentations of the tracks whose number of segments changed, n_segments maps track ids to their current
+    number of segments. The segment ids are compacted, and the tracks are segmented again after all the others. Returns
+    ids of the tracks whose segmentations were removed
+    """
+    resolver = SegmentResolver.from_db(length)
+    sizes = dict(zip(resolver.track_ids.tolist(), (resolver.stop_ids - resolver.start_ids).tolist()))
+    stale = [track_id for track_id, n in n_segments.items() if sizes.get(track_id, n) != n]
+    batch_size = current_app.config['DB_COMMIT_BATCH_SIZE']
+    for pos in range(0, len(stale), batch_size):
+        db.session.query(Segmentation).filter(Segmentation.length == length,
+                                              Segmentation.id.in_(stale[pos:pos + batch_size])).delete(
+            synchronize_session=False)
+    if stale:
+        compact_segmentations()
+    return stale
+
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.sql import func
+
+from .base import Segment, Track
+from .metadata import TrackMetadata
+
+
+class TrackCatalog:
+    """
+    Tracks together with their segmentations and metadata (artist, album, tags) loaded in a constant number of queries,
+    so that labels and ids for all tracks can be generated without lazy loading inside loops
+    """
+    def __init__(self, tracks: list[Track]):
+        self.tracks = tracks
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.tracks)
+
+    @staticmethod
+    def _query():
+        metadata = joinedload(Track.track_metadata)
+        return Track.query_all().options(
+            selectinload(Track.segmentations),
+            metadata.joinedload(TrackMetadata.artist),
+            metadata.joinedload(TrackMetadata.album),
+            metadata.selectinload(TrackMetadata.tags)
+        )
+
+    @classmethod
+    def from_ids(cls, track_ids: list[int]):
+        """Keeps the order of track_ids, ids without tracks are skipped"""
+        tracks = {track.id: track for track in cls._query().filter(Track.id.in_(set(track_ids)))}
+        return cls([tracks[track_id] for track_id in track_ids if track_id in tracks])
+
+    @classmethod
+    def get_all(cls, limit=None, random=False):
+        """Same as Track.get_all, but with everything eagerly loaded"""
+        query = cls._query()
+
+        if random:
+            query = query.order_by(func.random())
+
+        if limit is not None:
+            query = query.limit(limit)
+        return cls(query.all())
+
+    @property
+    def ids(self) -> list[int]:
+        return [track.id for track in self.tracks]
+
+    @property
+    def full_ids(self) -> list[str]:
+        return [track.full_id for track in self.tracks]
+
+    @property
+    def metadata(self) -> list[TrackMetadata]:
+        return [track.track_metadata for track in self.tracks]
+
+    def get_texts(self) -> list[str]:
+        return [track_metadata.to_text() for track_metadata in self.metadata]
+
+    def get_segments(self, length: int, sparse_factor: int = 1) -> list[list[Segment]]:
+        return [track.get_segments(length, sparse_factor) for track in self.tracks]
+
+    def get_segments_full_ids(self, length: int, sparse_factor: int = 1) -> list[list[str]]:
+        return [[segment.full_id for segment in segments] for segments in self.get_segments(length, sparse_factor)]
+
+    def get_segments_texts(self, length: int, sparse_factor: int = 1) -> list[list[str]]:
+        """Returns hovertexts for segments in format 'artist - track (m:ss~m:ss)'"""
+        return [[f'{track_text} ({segment.to_text()})' for segment in segments]
+                for track_text, segments in zip(self.get_texts(), self.get_segments(length, sparse_factor))]
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import BigInteger, Column, ForeignKey, Integer, String
+
+from .base import CommonMixin, db
+
+AudioSignature = Tuple[Optional[int], Optional[int]]
+
+
+class Extraction(CommonMixin, db.Model):
+    """
+    Manifest of the embeddings files: one row per track and model with the state of the audio and of the model that
+    produced the file, so that processing commands only touch new or changed tracks. For projections model_hash is the
+    fingerprint of the input model in the manifest
+    """
+    __tablename__ = 'extraction'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    id = Column(Integer, ForeignKey('track.id'), primary_key=True)
+    model = Column(String, primary_key=True)
+    audio_mtime = Column(BigInteger)  # in ns
+    audio_size = Column(BigInteger)
+    model_hash = Column(String)
+    n_rows = Column(Integer)
+    status = Column(String, index=True)
+
+    def __repr__(self):
+        return f'Extraction(id={self.id}, model={self.model}, status={self.status})'
+
+    @property
+    def audio_signature(self) -> AudioSignature:
+        return self.audio_mtime, self.audio_size
+
+
+def get_audio_signature(audio_file: Path) -> AudioSignature:
+    """Returns mtime and size of the audio file, or Nones if it doesn't exist"""
+    try:
+        stat = audio_file.stat()
+    except FileNotFoundError:
+        return None, None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def hash_file(path: Path, chunk_size: int = 2**20) -> str:
+    sha256 = hashlib.sha256()
+    with path.open('rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """Extraction rows of the models loaded in one query, changes are added to the session but not committed"""
+    def __init__(self, models: Iterable[str]):
+        query = db.session.query(Extraction).filter(Extraction.model.in_(list(models)))
+        self.rows = {(row.id, row.model): row for row in query}
+        self.track_ids = {row.id for row in self.rows.values()}
+
+    def get(self, track_id: int, model: str) -> Optional[Extraction]:
+        return self.rows.get((track_id, model))
+
+    def get_rows(self, model: str, status: Optional[str] = None) -> list[Extraction]:
+        return sorted((row for row in self.rows.values() if row.model == model and status in (None, row.status)),
+                      key=lambda row: row.id)
+
+    def has_track(self, track_id: int) -> bool:
+        return track_id in self.track_ids
+
+    def is_current(self, track_id: int, model: str, audio_signature: AudioSignature, model_hash: str) -> bool:
+        """Both done and failed rows are current, failed tracks are retried only when the audio or model changes"""
+        row = self.get(track_id, model)
+        return row is not None and row.audio_signature == tuple(audio_signature) and row.model_hash == model_hash
+
+    def is_derived_current(self, model: str, input_model: str) -> bool:
+        """Checks that model (e.g. projection) was computed from exactly the current state of input_model"""
+        inputs = self.get_rows(input_model, Extraction.DONE)
+        fingerprint = self.fingerprint(input_model)
+        rows = {row.id: row for row in self.get_rows(model, Extraction.DONE)}
+        return len(inputs) > 0 and all(row.id in rows and rows[row.id].model_hash == fingerprint for row in inputs)
+
+    def record(self, track_id: int, model: str, audio_signature: AudioSignature, model_hash: str, n_rows: int,
+               status: str = Extraction.DONE) -> Extraction:
+        row = self.get(track_id, model)
+        if row is None:
+            row = Extraction(id=track_id, model=model)
+            db.session.add(row)
+            self.rows[(track_id, model)] = row
+            self.track_ids.add(track_id)
+
+        row.audio_mtime, row.audio_size = audio_signature
+        row.model_hash = model_hash
+        row.n_rows = n_rows
+        row.status = status
+        return row
+
+    def fingerprint(self, model: str) -> str:
+        """Hash of the state of all the rows of the model, changes when any track is added, changed or failed"""
+        sha256 = hashlib.sha256()
+        for row in self.get_rows(model):
+            sha256.update(f'{row.id},{row.audio_mtime},{row.audio_size},{row.model_hash},{row.n_rows},'
+                          f'{row.status};'.encode())
+        return sha256.hexdigest()
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .base import db, get_stamp, touch_stamp
+from .metadata import Album, Artist, Tag, TrackMetadata, track_metadata_tag_table
+
+
+class Membership:
+    """
+    CSR-style membership of tracks in groups (tags, artists, albums): track ids of the i-th group in group_ids are
+    track_ids[indptr[i]:indptr[i + 1]], sorted. Groups with the same name are merged when grouping by name, the same way
+    names are shown in the highlight menu. Ranks keep the original order of the memberships (e.g. order of tags of a
+    track), so that grouping orders the names the same way as walking the relationships
+    """
+    def __init__(self, group_ids: np.ndarray, indptr: np.ndarray, track_ids: np.ndarray, ranks: np.ndarray,
+                 names: list):
+        self.group_ids = group_ids
+        self.indptr = indptr
+        self.track_ids = track_ids
+        self.ranks = ranks
+        codes = {}  # unique names
+        self.name_codes = np.array([codes.setdefault(name, len(codes)) for name in names], dtype=np.int64)
+        self.names = list(codes.keys())
+        self._entry_codes = np.repeat(self.name_codes, np.diff(indptr))
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[tuple[int, int]], names: dict[int, Optional[str]]):
+        """Builds membership from (group_id, track_id) pairs, names maps group ids to their names"""
+        pairs = np.array(list(pairs), dtype=np.int64).reshape(-1, 2)
+        ranks = np.lexsort((pairs[:, 1], pairs[:, 0]))
+        pairs = pairs[ranks]
+        group_ids, starts = np.unique(pairs[:, 0], return_index=True)
+        indptr = np.append(starts, len(pairs))
+        return cls(group_ids, indptr, np.ascontiguousarray(pairs[:, 1]), ranks,
+                   [names.get(group_id) for group_id in group_ids.tolist()])
+
+    def __len__(self):
+        return len(self.group_ids)
+
+    def get_tracks(self, group_ids) -> np.ndarray:
+        """Returns sorted ids of the tracks that belong to any of the groups"""
+        group_ids = np.asarray(group_ids, dtype=np.int64)
+        rows = np.searchsorted(self.group_ids, group_ids)
+        found = rows < len(self)
+        rows = rows[found][self.group_ids[rows[found]] == group_ids[found]]
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([self.track_ids[self.indptr[row]:self.indptr[row + 1]] for row in rows]))
+
+    def group_by_name(self, track_ids) -> dict[Optional[str], list[int]]:
+        """
+        Returns ids of the given tracks grouped by the names of their groups. Like the tracks in each group, the groups
+        are ordered by the first appearance in track_ids
+        """
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        if len(track_ids) == 0:
+            return {}
+        order = np.argsort(track_ids)
+        sorted_ids = track_ids[order]
+        indices = np.minimum(np.searchsorted(sorted_ids, self.track_ids), len(sorted_ids) - 1)
+        found = sorted_ids[indices] == self.track_ids
+
+        positions = order[indices[found]]  # position in track_ids of every membership of the given tracks
+        codes = self._entry_codes[found]
+        ranks = self.ranks[found]
+        entries = np.lexsort((ranks, positions, codes))
+        positions, codes, ranks = positions[entries], codes[entries], ranks[entries]
+
+        unique_codes, starts = np.unique(codes, return_index=True)
+        groups = np.split(track_ids[positions], starts[1:])
+        result = {}
+        for i in np.lexsort((ranks[starts], positions[starts])).tolist():
+            result[self.names[unique_codes[i]]] = groups[i].tolist()
+        return result
+
+
+class MembershipIndex:
+    """Memberships of tracks in tags, artists, albums and track names, loaded from the database with one query each"""
+    def __init__(self, tag: Membership, artist: Membership, album: Membership, track: Membership):
+        self.tag = tag
+        self.artist = artist
+        self.album = album
+        self.track = track  # every track is its own group, so tracks are grouped by their names
+
+    @classmethod
+    def from_db(cls):
+        tag = Membership.from_pairs(
+            db.session.query(track_metadata_tag_table.c.tag_id, track_metadata_tag_table.c.track_id),
+            dict(db.session.query(Tag.id, Tag.name))
+        )
+        artist = Membership.from_pairs(
+            db.session.query(TrackMetadata.artist_id, TrackMetadata.id).filter(TrackMetadata.artist_id.isnot(None)),
+            dict(db.session.query(Artist.id, Artist.name))
+        )
+        album = Membership.from_pairs(
+            db.session.query(TrackMetadata.album_id, TrackMetadata.id).filter(TrackMetadata.album_id.isnot(None)),
+            dict(db.session.query(Album.id, Album.name))
+        )
+        names = dict(db.session.query(TrackMetadata.id, TrackMetadata.name))
+        track = Membership.from_pairs(((track_id, track_id) for track_id in names.keys()), names)
+        return cls(tag, artist, album, track)
+
+    def select(self, tag_ids, artist_ids) -> np.ndarray:
+        """
+        Returns sorted ids of the tracks that have any of the tags or any of the artists. Tracks without any tags are
+        never selected, the same way as with TrackMetadata.get_by_tags_and_artists
+        """
+        selected = np.union1d(self.tag.get_tracks(tag_ids), self.artist.get_tracks(artist_ids))
+        return np.intersect1d(selected, self.tag.track_ids)
+
+    def get_highlight_groups(self, track_ids) -> dict[str, dict[Optional[str], list[int]]]:
+        return {
+            'artist': self.artist.group_by_name(track_ids),
+            'album': self.album.group_by_name(track_ids),
+            'track': self.track.group_by_name(track_ids),
+            'tag': self.tag.group_by_name(track_ids)
+        }
+
+
+_membership_index: Optional[tuple[tuple[int, int], MembershipIndex]] = None
+
+
+def get_membership_index() -> MembershipIndex:
+    """
+    Returns process-wide membership index, it is built on the first use and rebuilt when the metadata was modified by
+    any process since then
+    """
+    global _membership_index
+    stamp = get_stamp('metadata')  # before the queries, so that changes committed during them trigger another rebuild
+    if _membership_index is None or _membership_index[0] != stamp:
+        _membership_index = stamp, MembershipIndex.from_db()
+    return _membership_index[1]
+
+
+def reset_membership_index():
+    """Should be called after changes of the metadata are committed, so the index is rebuilt in all processes"""
+    touch_stamp('metadata')
@@ -11,6 +11,10 @@ class NameMixin(CommonMixin):
     def get_by_name(cls, name):
         return db.session.query(cls).filter_by(name=name).first()
 
+    @classmethod
+    def get_ids_by_name(cls) -> dict:
+        return dict(db.session.query(cls.name, cls.id))
+
     def __lt__(self, other):
         return (self.name is None, self.name) < (other.name is None, other.name)
 
@@ -78,3 +82,7 @@ class Tag(NameMixin, db.Model):
     @staticmethod
     def get_by_name_and_group(tag_name, tag_group):
         return db.session.query(Tag).filter(Tag.name == tag_name).filter(Tag.group == tag_group).first()
+
+    @staticmethod
+    def get_ids_by_name_and_group() -> dict:
+        return {(name, group): _id for _id, name, group in db.session.query(Tag.id, Tag.name, Tag.group)}
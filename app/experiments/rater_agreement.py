@@ -5,29 +5,19 @@ import numpy as np
 import pandas as pd
 from flask.cli import with_appcontext
 
-from app.database.base import Segment, Segmentation
-
-
-def get_url_suffix(segment_length, segment_id):
-    print(segment_length, segment_id)
-    segment = Segment.get_by_id(segment_length, segment_id)
-    return segment.get_url_suffix()
+from app.database.base import get_segment_resolver
 
 
 def generate_pairs(output_dir: Path, n_queries: int, n_candidates: int, segment_length: int = 3000):
-    total = Segmentation.get_total_segments(segment_length)
-    ids = np.random.randint(total, size=(n_queries, n_candidates + 1))
+    resolver = get_segment_resolver(segment_length)
+    ids = np.random.randint(resolver.total, size=(n_queries, n_candidates + 1))
     print(ids)
 
-    suffixes = []
-    for ids_row in ids:
-        row = []
-        for id_value in ids_row:
-            row.append(get_url_suffix(segment_length, id_value))
-        suffixes.append(row)
+    segments = resolver.get_segments(ids.ravel())
+    suffixes = np.reshape([segment.get_url_suffix() for segment in segments], ids.shape)
 
     output_dir.mkdir(exist_ok=True, parents=True)
-    np.save(str(output_dir / 'ids.npy'))
+    np.save(str(output_dir / 'ids.npy'), ids)
     pd.DataFrame(suffixes).to_csv(str(output_dir / 'suffixes.csv'), header=False, index=False)
 
 
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import logging
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Iterable, Optional, Union
+
+import numpy as np
+from annoy import AnnoyIndex
+from flask import current_app
+
+if TYPE_CHECKING:
+    from .models import Model
+
+
+class FanOutIndex:
+    """
+    Base index together with the delta index of the items that were added incrementally after the base was built.
+    Delta has local ids starting from 0 for the item offset (the number of items in the base). Supports the part of
+    AnnoyIndex interface that is used for querying, results of both indexes are merged by distance. Metric is the
+    distance the indexes were built with, for 'dot' Annoy returns similarities, so larger values come first
+    """
+    def __init__(self, base: AnnoyIndex, delta: AnnoyIndex, metric: str):
+        self.base = base
+        self.delta = delta
+        self.metric = metric
+        self.offset = base.get_n_items()
+
+    def get_n_items(self) -> int:
+        return self.offset + self.delta.get_n_items()
+
+    def get_item_vector(self, i: int) -> list[float]:
+        if i < self.offset:
+            return self.base.get_item_vector(i)
+        return self.delta.get_item_vector(i - self.offset)
+
+    def get_distance(self, i: int, j: int) -> float:
+        if i < self.offset and j < self.offset:
+            return self.base.get_distance(i, j)
+        if i >= self.offset and j >= self.offset:
+            return self.delta.get_distance(i - self.offset, j - self.offset)
+        # items are in different indexes, the distance is computed the same way as Annoy does
+        u, v = np.array(self.get_item_vector(i)), np.array(self.get_item_vector(j))
+        metric = self.metric
+        if metric == 'angular':
+            cos = np.dot(u, v) / max(np.linalg.norm(u) * np.linalg.norm(v), 1e-30)
+            return float(np.sqrt(max(2 - 2 * cos, 0)))
+        if metric == 'euclidean':
+            return float(np.linalg.norm(u - v))
+        if metric == 'manhattan':
+            return float(np.abs(u - v).sum())
+        if metric == 'dot':
+            return float(np.dot(u, v))
+        if metric == 'hamming':
+            bits = np.bitwise_xor(u.astype(np.uint64), v.astype(np.uint64))
+            return float(sum(bin(x).count('1') for x in bits.tolist()))
+        raise ValueError(f'Unknown Annoy distance: {metric}')
+
+    def get_nns_by_vector(self, vector, n: int, search_k: int = -1, include_distances: bool = False):
+        base_ids, base_distances = self.base.get_nns_by_vector(vector, n, search_k, include_distances=True)
+        delta_ids, delta_distances = self.delta.get_nns_by_vector(vector, n, search_k, include_distances=True)
+        delta_ids = [i + self.offset for i in delta_ids]
+
+        sign = -1 if self.metric == 'dot' else 1
+        merged = sorted(zip(base_distances + delta_distances, base_ids + delta_ids),
+                        key=lambda item: (sign * item[0], item[1]))[:n]
+        ids = [i for _, i in merged]
+        if include_distances:
+            return ids, [distance for distance, _ in merged]
+        return ids
+
+    def get_nns_by_item(self, i: int, n: int, search_k: int = -1, include_distances: bool = False):
+        return self.get_nns_by_vector(self.get_item_vector(i), n, search_k, include_distances)
+
+
+def _get_file_version(path: Path) -> Optional[tuple[int, int]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def get_index_version(model: Model) -> tuple:
+    """Identifies the index files of the model on disk, indexing always replaces them with new files"""
+    return _get_file_version(model.index_file), _get_file_version(model.delta_index_file)
+
+
+@dataclass
+class IndexStats:
+    path: str
+    n_items: int
+    size: int  # bytes that are memory-mapped
+    load_time: float  # in seconds
+
+
+class IndexPool:
+    """
+    Process-wide pool of loaded Annoy indexes, keyed by model name. Annoy memory-maps index files, so when the pool is
+    preloaded in the uWSGI master process before the workers fork, all workers share the same pages and requests get
+    the index without any file I/O. When the index files are replaced (e.g. by incremental indexing), each worker loads
+    the new files on its next request
+    """
+    def __init__(self):
+        self._indexes: dict[str, Union[AnnoyIndex, FanOutIndex]] = {}
+        self._versions: dict[str, tuple] = {}
+        self.stats: dict[str, IndexStats] = {}
+        self._lock = threading.Lock()
+
+    def load(self, model: Model) -> Union[AnnoyIndex, FanOutIndex]:
+        """Loads the index of the model, together with the delta index if there is one"""
+        start = perf_counter()
+        version = get_index_version(model)  # before loading, so that files replaced meanwhile are loaded again
+        index = AnnoyIndex(model.n_dimensions, current_app.config['ANNOY_DISTANCE'])
+        index.load(str(model.index_file))
+        size = model.index_file.stat().st_size
+
+        if model.delta_index_file.exists():
+            delta = AnnoyIndex(model.n_dimensions, current_app.config['ANNOY_DISTANCE'])
+            delta.load(str(model.delta_index_file))
+            size += model.delta_index_file.stat().st_size
+            index = FanOutIndex(index, delta, current_app.config['ANNOY_DISTANCE'])
+        load_time = perf_counter() - start
+
+        stats = IndexStats(str(model.index_file), index.get_n_items(), size, load_time)
+        logging.info(f'Loaded {model} index: {stats.n_items} items, {stats.size / 2**20:.1f} MiB, '
+                     f'{stats.load_time * 1000:.1f} ms')
+
+        self._indexes[str(model)] = index
+        self._versions[str(model)] = version
+        self.stats[str(model)] = stats
+        return index
+
+    def _is_current(self, model: Model) -> bool:
+        return str(model) in self._indexes and self._versions[str(model)] == get_index_version(model)
+
+    def get(self, model: Model) -> Union[AnnoyIndex, FanOutIndex]:
+        """
+        Returns preloaded index, the index is loaded on first use if it wasn't preloaded, and reloaded if its files were
+        replaced since it was loaded
+        """
+        if not self._is_current(model):
+            with self._lock:
+                if not self._is_current(model):
+                    return self.load(model)
+        return self._indexes[str(model)]
+
+    def preload(self, models: Iterable[Model]):
+        """Loads indexes of all models that have index file in INDEX_DIR"""
+        for model in models:
+            if model.index_file.exists():
+                self.load(model)
+
+        total_size = sum(stats.size for stats in self.stats.values())
+        total_time = sum(stats.load_time for stats in self.stats.values())
+        logging.info(f'Preloaded {len(self.stats)} indexes: {total_size / 2**20:.1f} MiB, {total_time:.2f} s')
+
+    def get_stats(self) -> dict[str, dict]:
+        return {name: asdict(stats) for name, stats in self.stats.items()}
+
+
+index_pool = IndexPool()
@@ -0,0 +1,240 @@
+from __future__ import annotations
+
+import _thread
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from flask import Blueprint, current_app
+
+bp = Blueprint('jobs', __name__, url_prefix='/jobs')
+
+JOB_ID = re.compile(r'[0-9a-f]+')
+JOB_ACTIVE = ('pending', 'running')
+JOB_TTL = 24 * 60 * 60  # in seconds, finished jobs are forgotten after that
+CANCEL_CHECK_INTERVAL = 1  # in seconds
+
+# progress printed by t-SNE (verbose=2) and UMAP (verbose=True), newer UMAP versions show tqdm progress bar instead
+TSNE_ITERATION = re.compile(r'Iteration (\d+):')
+UMAP_EPOCHS = re.compile(r'(\d+)\s*/\s*(\d+)\s+epochs')
+UMAP_TQDM = re.compile(r'(\d+)/(\d+) \[')
+LINE_END = re.compile(r'[\r\n]')
+
+_executor = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    State of a background job in JOBS_DIR, shared by all the workers: <id>.json has status and progress, and existing
+    <id>.cancel asks the job to stop
+    """
+    def __init__(self, jobs_dir, job_id: str):
+        self.id = job_id
+        self.status_file = Path(jobs_dir) / f'{job_id}.json'
+        self.cancel_file = Path(jobs_dir) / f'{job_id}.cancel'
+
+    def read(self) -> Optional[dict]:
+        try:
+            with self.status_file.open() as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write(self, status: str, progress: float = 0, error: Optional[str] = None):
+        self.status_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self.status_file.parent, suffix='.tmp', delete=False) as fp:
+            json.dump({'id': self.id, 'status': status, 'progress': progress, 'error': error}, fp)
+        os.replace(fp.name, self.status_file)
+
+    def cancel(self):
+        self.cancel_file.touch()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_file.exists()
+
+    def clear(self):
+        for path in [self.status_file, self.cancel_file]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ProgressWriter(io.TextIOBase):
+    """Replaces stdout and stderr in the job process: reports progress printed by the projection and stops it by
+    raising JobCancelled from inside the fit once the job is cancelled. Output is parsed by lines, because print with
+    several arguments writes them one by one, and tqdm separates its updates with \\r"""
+    def __init__(self, job: Job, projection: str, n_iterations: int):
+        self.job = job
+        self.projection = projection
+        self.n_iterations = n_iterations
+        self._line = ''
+
+    def _parse_progress(self, line) -> Optional[float]:
+        if self.projection == 'tsne':
+            match = TSNE_ITERATION.search(line)
+            return int(match[1]) / self.n_iterations if match else None
+        match = UMAP_EPOCHS.search(line) or UMAP_TQDM.search(line)
+        return int(match[1]) / int(match[2]) if match else None
+
+    def write(self, text):
+        if self.job.cancelled:
+            raise JobCancelled()
+
+        *lines, self._line = LINE_END.split(self._line + text)
+        progress = None
+        for line in lines:
+            line_progress = self._parse_progress(line)
+            if line_progress is not None:
+                progress = line_progress
+        if progress is not None:
+            self.job.write('running', min(progress, 1))
+        return len(text)
+
+
+class CancelWatcher:
+    """
+    Checks for cancellation in a thread while the projection runs, so that it can be stopped even if it doesn't print
+    anything. The main thread of the job process is interrupted, and the SIGINT handler raises JobCancelled there
+    """
+    def __init__(self, job: Job, interval: float = CANCEL_CHECK_INTERVAL):
+        self.job = job
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._previous_handler = None
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            if self.job.cancelled:
+                with self._lock:
+                    if not self._stopped.is_set():
+                        _thread.interrupt_main()
+                return
+
+    def _handle_interrupt(self, signum, frame):
+        if not self._stopped.is_set():  # the interrupt can arrive after the projection finished
+            raise JobCancelled()
+
+    def __enter__(self):
+        self._previous_handler = signal.signal(signal.SIGINT, self._handle_interrupt)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            with self._lock:
+                self._stopped.set()
+        finally:
+            self._thread.join()
+            signal.signal(signal.SIGINT, self._previous_handler)
+
+
+def run_projection(jobs_dir, job_id: str, cache_dir, cache_size: int, projection: str, track_ids: list[int],
+                   embeddings: list[np.ndarray]):
+    """Runs in the pool process: fits the projection and puts the result into the projection cache"""
+    from .processing.reduce import REDUCE, TSNE_PARAMS
+    from .projection_cache import ProjectionCache
+
+    job = Job(jobs_dir, job_id)
+    if job.cancelled:
+        job.write('cancelled')
+        return
+
+    job.write('running')
+    writer = ProgressWriter(job, projection, TSNE_PARAMS.get('n_iter', 1000))
+    try:
+        with CancelWatcher(job), redirect_stdout(writer), redirect_stderr(writer):
+            embeddings = REDUCE[projection](embeddings, verbose=2)
+    except JobCancelled:
+        job.write('cancelled')
+        return
+    except Exception as e:
+        job.write('failed', error=str(e))
+        return
+
+    ProjectionCache(cache_dir, cache_size).put(job_id, track_ids, embeddings)
+    job.write('done', 1)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Pool is created on first use, so each uWSGI worker creates it after forking"""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(current_app.config['JOBS_WORKERS'],
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def _remove_expired(jobs_dir: Path):
+    now = time.time()
+    for status_file in jobs_dir.glob('*.json'):
+        try:
+            if now - status_file.stat().st_mtime > JOB_TTL:
+                Job(jobs_dir, status_file.stem).clear()
+        except FileNotFoundError:
+            pass
+
+
+def submit_projection(job_id: str, projection: str, track_ids: list[int], embeddings: list[np.ndarray]) -> str:
+    """Submits projection to the pool, unless the job with the same id is already pending or running. The job id is
+    the projection cache key, so the result can be retrieved from the cache when the job is done"""
+    config = current_app.config
+    jobs_dir = Path(config['JOBS_DIR'])
+    job = Job(jobs_dir, job_id)
+
+    state = job.read()
+    if state is not None and state['status'] in JOB_ACTIVE and not job.cancelled:
+        return job_id
+
+    _remove_expired(jobs_dir)
+    job.clear()
+    job.write('pending')
+    _get_executor().submit(run_projection, jobs_dir, job_id, config['PROJECTION_CACHE_DIR'],
+                           config['PROJECTION_CACHE_SIZE'], projection, track_ids, embeddings)
+    logging.info(f'Submitted {projection} job {job_id} for {len(track_ids)} tracks')
+    return job_id
+
+
+def _get_job(job_id: str) -> Optional[Job]:
+    if not JOB_ID.fullmatch(job_id):
+        return None
+    job = Job(current_app.config['JOBS_DIR'], job_id)
+    return job if job.status_file.exists() else None
+
+
+@bp.route('/<string:job_id>')
+def get_job(job_id):
+    job = _get_job(job_id)
+    state = job.read() if job is not None else None
+    if state is None:
+        return {'error': f'No job {job_id}'}, 404
+    return state
+
+
+@bp.route('/<string:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """POST, so it can be called with navigator.sendBeacon when user leaves the page"""
+    job = _get_job(job_id)
+    if job is None:
+        return {'error': f'No job {job_id}'}, 404
+    job.cancel()
+    return {}, 200
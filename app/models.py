@@ -9,6 +9,11 @@ import yaml
 from annoy import AnnoyIndex
 from flask import Blueprint, current_app, g
 
+from .aggrdata import aggrdata
+from .database.base import get_segment_resolver
+from .indexes import index_pool
+from .prefetch import prefetch
+
 bp = Blueprint('models', __name__)
 
 
@@ -40,6 +45,11 @@ class Model:
     def index_file(self):
         return Path(current_app.config['INDEX_DIR']) / f'{self}.ann'
 
+    @property
+    def delta_index_file(self):
+        """Index of the segments that were added incrementally after index_file was built"""
+        return Path(current_app.config['INDEX_DIR']) / f'{self}.delta.ann'
+
     @property
     def data_dir(self):
         return Path(current_app.config['DATA_DIR']) / str(self)
@@ -63,11 +73,12 @@ class Model:
         return new_model
 
     def get_annoy_index(self, load=True):
+        """Returns shared index from the pool, or a new empty index for building if load is False"""
         if not hasattr(self, 'index'):
-            self.index = AnnoyIndex(self.n_dimensions, current_app.config['ANNOY_DISTANCE'])
             if load:
-                print(str(self.index_file))
-                self.index.load(str(self.index_file))
+                self.index = index_pool.get(self)
+            else:
+                self.index = AnnoyIndex(self.n_dimensions, current_app.config['ANNOY_DISTANCE'])
         return self.index
 
     def get_embeddings_from_annoy(self, tracks, sparse_factor, dimensions=None):
@@ -82,20 +93,22 @@ class Model:
             embeddings.append(track_embeddings)
         return embeddings
 
-    def get_embeddings_from_file(self, tracks, dimensions=None):
-        # alternative way of reading from file, is 2x faster
+    def iter_embeddings_from_file(self, tracks, dimensions=None):
+        """Yields embeddings of the tracks in their order, the files are loaded ahead by a pool of threads"""
+        data_dir = self.data_dir
+        embeddings = prefetch(data_dir / track.get_embeddings_filename() for track in tracks)
         if dimensions is None:
-            return [track.get_embeddings_from_file(self.data_dir) for track in tracks]
+            return embeddings
 
-        return [track.get_embeddings_from_file(self.data_dir)[:, dimensions] for track in tracks]
+        return (track_embeddings[:, dimensions] for track_embeddings in embeddings)
 
-    def get_embeddings_from_aggrdata(self, tracks, sparse_factor, dimensions=None):
-        embeddings_file = Path(current_app.config['AGGRDATA_DIR']) / f'{self}.npy'
-        embeddings = np.load(str(embeddings_file), mmap_mode='r')
-        if dimensions is None:
-            return [embeddings[track.get_aggrdata_slice(self.length, sparse_factor)] for track in tracks]
+    def get_embeddings_from_file(self, tracks, dimensions=None):
+        # alternative way of reading from file, is 2x faster
+        return list(self.iter_embeddings_from_file(tracks, dimensions))
 
-        return [embeddings[track.get_aggrdata_slice(self.length, sparse_factor), dimensions] for track in tracks]
+    def get_embeddings_from_aggrdata(self, tracks, sparse_factor, dimensions=None):
+        starts, stops = get_segment_resolver(self.length).get_ranges([track.id for track in tracks])
+        return aggrdata.gather(str(self), starts, stops, sparse_factor, dimensions)
 
     def get_embeddings(self, tracks, sparse_factor=1, dimensions=None):
         return self.get_embeddings_from_aggrdata(tracks, sparse_factor, dimensions)
@@ -151,3 +164,8 @@ def get_models():
 @bp.route('/metadata')
 def get_metadata():
     return get_models().data
+
+
+@bp.route('/metadata/indexes')
+def get_indexes_stats():
+    return index_pool.get_stats()
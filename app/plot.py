@@ -1,20 +1,27 @@
+import base64
 import json
+from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import plotly
 import plotly.graph_objects as go
 from flask import Blueprint, current_app, request
 
-from .cache import cache
-from .database.base import Track
-from .database.metadata import TrackMetadata
+from . import jobs
+from .database.catalog import TrackCatalog
+from .database.membership import get_membership_index
 from .models import Model, get_models
-from .processing.reduce import reduce_tsne, reduce_umap
+from .processing.reduce import (TSNE_PARAMS, UMAP_PARAMS, get_transformer, get_transformer_file, reduce_tsne,
+                                reduce_umap, transform_generic)
+from .projection_cache import get_projection_cache
 
 bp = Blueprint('plot', __name__)
 
 PLOTLY_MARGINS = {'l': 40, 'r': 0, 't': 30, 'b': 40}
 PLOTLY_MARKER_SCALE = 10
+PLOTLY_MARKER_COLORS = plotly.colors.qualitative.Plotly
+TYPED_ARRAY_KEYS = ['x', 'y']
 
 
 def get_averages(embeddings):
@@ -24,16 +31,16 @@ def get_averages(embeddings):
     return avg, std
 
 
-def plot_averages(embeddings, tracks):
+def plot_averages(embeddings, catalog: TrackCatalog):
     avg, std = get_averages(embeddings)
     fig = go.Figure(data=go.Scatter(
         x=avg[:, 0],
         y=avg[:, 1],
         mode='markers',
         marker={'size': std * PLOTLY_MARKER_SCALE},
-        hovertext=[track.track_metadata.to_text() for track in tracks],
+        hovertext=catalog.get_texts(),
         hoverinfo='text',
-        ids=[track.full_id for track in tracks],
+        ids=catalog.full_ids,
         # marker_color=[track.track_metadata.artist_id for track in tracks]
     ))
     return fig
@@ -52,22 +59,22 @@ def get_trajectories(embeddings):
     return trajectories, lengths
 
 
-def plot_segments(embeddings, tracks, segment_length, show_trajectories=False):
+def plot_segments(embeddings, catalog: TrackCatalog, segment_length, show_trajectories=False):
     trajectories, lengths = get_trajectories(embeddings)  # TODO: check if needed
     fig = go.Figure()
 
     mode = 'lines+markers' if show_trajectories else 'markers'
     args = {} if show_trajectories else {'marker_color': plotly.colors.qualitative.Plotly[0]}
 
-    for (x, y), length, track in zip(trajectories, lengths, tracks):
-        segments = track.get_segments(segment_length)
-        track_text = track.track_metadata.to_text()
+    for (x, y), track_text, full_ids, texts in zip(trajectories, catalog.get_texts(),
+                                                   catalog.get_segments_full_ids(segment_length),
+                                                   catalog.get_segments_texts(segment_length)):
         fig.add_trace(go.Scatter(
             x=x,
             y=y,
             mode=mode,
-            ids=[segment.full_id for segment in segments],
-            hovertext=[f'{track_text} ({segment.to_text()})' for segment in segments],
+            ids=full_ids,
+            hovertext=texts,
             hoverinfo='text',
             name=track_text,
             showlegend=False,
@@ -77,15 +84,19 @@ def plot_segments(embeddings, tracks, segment_length, show_trajectories=False):
     return fig
 
 
-def get_plotly_fig(plot_type, embeddings, tracks, model):
+def get_plotly_fig(plot_type, embeddings, catalog, model):
     """
     Parses plot_type and calls corresponding plot function.
     :raises ValueError: invalid plot_type
     """
     if plot_type == 'averages':
-        fig = plot_averages(embeddings, tracks)
+        fig = plot_averages(embeddings, catalog)
     elif plot_type in ['trajectories', 'segments']:
-        fig = plot_segments(embeddings, tracks, model.length, show_trajectories=(plot_type == 'trajectories'))
+        show_trajectories = plot_type == 'trajectories'
+        if len(catalog) > current_app.config['PLOT_COLUMNAR_THRESHOLD']:
+            fig = plot_segments_columnar(embeddings, catalog, model.length, show_trajectories=show_trajectories)
+        else:
+            fig = plot_segments(embeddings, catalog, model.length, show_trajectories=show_trajectories)
     else:
         raise ValueError(f"Invalid plot_type: {plot_type}, should be 'averages', 'trajectories' or 'segments'")
 
@@ -110,19 +121,19 @@ def plot(plot_type, dataset, architecture, layer, n_tracks, projection, x, y):
             model_projection = projection
         model = Model(get_models().data, dataset, architecture, layer, model_projection)
 
-        tracks = Track.get_all(limit=n_tracks, random=False)
+        catalog = TrackCatalog.get_all(limit=n_tracks, random=False)
 
-        dimensions = slice(current_app.config['PCA_DIMS']) if dynamic_projection else [x, y]
+        if dynamic_projection and request.args.get('async'):
+            job_id = submit_projection_job(model.with_projection(projection), catalog.tracks, 1)
+            if job_id is not None:
+                return {'job': job_id}, 202
 
-        embeddings = model.get_embeddings(tracks, dimensions=dimensions)
+        if dynamic_projection:
+            embeddings = get_embeddings_and_project(model.with_projection(projection), catalog.tracks, 1)
+        else:
+            embeddings = model.get_embeddings(catalog.tracks, dimensions=[x, y])
 
-        # TODO: time the projection, alert user if it is too slow?
-        if projection == 'tsne':
-            embeddings = reduce_tsne(embeddings)
-        elif projection == 'umap':
-            embeddings = reduce_umap(embeddings)
-
-        figure = get_plotly_fig(plot_type, embeddings, tracks, model)
+        figure = get_plotly_fig(plot_type, embeddings, catalog, model)
 
         # add labels on axis if those are tags
         if projection == 'original' and layer == 'taggrams':
@@ -138,18 +149,33 @@ def plot(plot_type, dataset, architecture, layer, n_tracks, projection, x, y):
     except FileNotFoundError as e:
         return {'error': str(e)}, 404
 
+    figure = figure.to_dict()
+    if request.args.get('format') == 'bdata':
+        encode_typed_arrays(figure)
     return json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder)
 
 
-def plot_segments_advanced(embeddings, tracks, segment_length, sparse_factor, highlight_ids, use_webgl):
+def encode_typed_arrays(figure: dict) -> dict:
+    """Replaces coordinates of the traces with base64-encoded float32 arrays in the Plotly 'bdata' format, which is
+    several times smaller and faster to encode than decimal strings. Decoded by decodeTypedArrays in commons.js"""
+    for trace in figure['data']:
+        for key in TYPED_ARRAY_KEYS:
+            if key in trace:
+                data = np.asarray(trace[key], dtype='<f4')
+                trace[key] = {'dtype': 'f4', 'bdata': base64.b64encode(data.tobytes()).decode('ascii')}
+    return figure
+
+
+def plot_segments_advanced(embeddings, catalog: TrackCatalog, segment_length, sparse_factor, highlight_ids,
+                           use_webgl):
     fig = go.Figure()
     scale = plotly.colors.qualitative.Plotly
 
     # groups = {}
 
-    for track_embeddings, track in zip(embeddings, tracks):
-        segments = track.get_segments(segment_length, sparse_factor)
-        track_text = track.track_metadata.to_text()
+    for track_embeddings, track, track_text, full_ids, texts in zip(
+            embeddings, catalog, catalog.get_texts(), catalog.get_segments_full_ids(segment_length, sparse_factor),
+            catalog.get_segments_texts(segment_length, sparse_factor)):
 
         # group_id = track.track_metadata.artist_id
         # if group_id not in groups:
@@ -160,8 +186,8 @@ def plot_segments_advanced(embeddings, tracks, segment_length, sparse_factor, hi
             x=track_embeddings[:, 0],
             y=track_embeddings[:, 1],
             mode='markers',
-            ids=[segment.full_id for segment in segments],
-            hovertext=[f'{track_text} ({segment.to_text()})' for segment in segments],
+            ids=full_ids,
+            hovertext=texts,
             hoverinfo='text',
             name=track_text,
             showlegend=False,
@@ -173,26 +199,56 @@ def plot_segments_advanced(embeddings, tracks, segment_length, sparse_factor, hi
     return fig
 
 
-def _append(result: dict, name: str, value: str):
-    if name not in result:
-        result[name] = []
-    result[name].append(value)
-
+def plot_segments_columnar(embeddings, catalog: TrackCatalog, segment_length, sparse_factor=1,
+                           show_trajectories=False, highlight_ids=(), use_webgl=False):
+    """
+    Same as plot_segments and plot_segments_advanced, but all tracks are concatenated into one trace per highlight
+    group, which is much faster to build and render for many tracks. customdata has index of the track in the catalog,
+    trajectories of different tracks are separated by NaN points (with -1 in customdata)
+    """
+    fig = go.Figure()
+    scatter = go.Scattergl if use_webgl else go.Scatter
+    mode = 'lines+markers' if show_trajectories else 'markers'
+    args = {'line_shape': 'spline'} if show_trajectories else {}  # spline is not supported by Scattergl
+
+    highlight_ids = set(highlight_ids)
+    highlighted = np.array([track.id in highlight_ids for track in catalog], dtype=bool)
+    full_ids = catalog.get_segments_full_ids(segment_length, sparse_factor)
+    texts = catalog.get_segments_texts(segment_length, sparse_factor)
+    separator = np.full((1, 2), np.nan)
+
+    for is_highlighted, color in [(False, PLOTLY_MARKER_COLORS[0]), (True, PLOTLY_MARKER_COLORS[1])]:
+        track_indices = np.flatnonzero(highlighted == is_highlighted)
+        if len(track_indices) == 0:
+            continue
+
+        points, group_ids, group_texts, customdata = [], [], [], []
+        for i in track_indices:
+            points.append(embeddings[i][:, :2])
+            group_ids += full_ids[i]
+            group_texts += texts[i]
+            customdata.append(np.full(len(embeddings[i]), i))
+            if show_trajectories:
+                points.append(separator)
+                group_ids.append('')
+                group_texts.append('')
+                customdata.append([-1])
+
+        points = np.concatenate(points)
+        fig.add_trace(scatter(
+            x=points[:, 0],
+            y=points[:, 1],
+            mode=mode,
+            ids=group_ids,
+            hovertext=group_texts,
+            hoverinfo='text',
+            customdata=np.concatenate(customdata),
+            showlegend=False,
+            marker={'color': color},
+            **args
+        ))
 
-def get_highlight_groups(tracks_meta):
-    results = {
-        'artist': {},
-        'album': {},
-        'track': {},
-        'tag': {}
-    }
-    for track_meta in tracks_meta:
-        _append(results['artist'], track_meta.artist.name, track_meta.id)
-        _append(results['album'], track_meta.album.name, track_meta.id)
-        _append(results['track'], track_meta.name, track_meta.id)
-        for tag in track_meta.tags:
-            _append(results['tag'], tag.name, track_meta.id)
-    return results
+    return fig
 
 
 @bp.route('/plot-advanced', methods=['POST'])
@@ -201,8 +257,8 @@ def plot_advanced():
     data_query = request.json['data']
     tag_ids = [int(tag) for tag in data_query['tags']]
     artist_ids = [int(artist) for artist in data_query['artists']]
-    tracks_meta = TrackMetadata.get_by_tags_and_artists(tag_ids, artist_ids)
-    tracks = [track_meta.track for track_meta in tracks_meta]
+    membership_index = get_membership_index()
+    catalog = TrackCatalog.from_ids(membership_index.select(tag_ids, artist_ids).tolist())
 
     sparse_factor = int(data_query['sparse'])
     use_webgl = data_query['webgl']
@@ -212,23 +268,39 @@ def plot_advanced():
     # logging.info(highlight_ids)
 
     # models
-    result_plots = {}
+    models = {}
     for plot_side, model_query in request.json['models'].items():
         projection = model_query['projection']
         if projection == 'original':
             projection = None
 
-        model = Model(get_models().data, model_query['dataset'], model_query['architecture'],
-                      model_query['layer'], projection)
+        models[plot_side] = Model(get_models().data, model_query['dataset'], model_query['architecture'],
+                                  model_query['layer'], projection)
 
-        embeddings = get_embeddings_and_project(model, tracks, sparse_factor)
+    # slow projections are computed in the background, client polls the jobs and requests the plots again
+    if request.json.get('async'):
+        job_ids = [submit_projection_job(model, catalog.tracks, sparse_factor) for model in models.values()]
+        job_ids = [job_id for job_id in job_ids if job_id is not None]
+        if job_ids:
+            return {'jobs': job_ids}, 202
 
-        figure = plot_segments_advanced(embeddings, tracks, model.length, sparse_factor, highlight_ids, use_webgl)
+    result_plots = {}
+    for plot_side, model in models.items():
+        embeddings = get_embeddings_and_project(model, catalog.tracks, sparse_factor)
+
+        if len(catalog) > current_app.config['PLOT_COLUMNAR_THRESHOLD']:
+            figure = plot_segments_columnar(embeddings, catalog, model.length, sparse_factor,
+                                            highlight_ids=highlight_ids, use_webgl=use_webgl)
+        else:
+            figure = plot_segments_advanced(embeddings, catalog, model.length, sparse_factor, highlight_ids,
+                                            use_webgl)
         figure.update_layout(margin=PLOTLY_MARGINS)
         # result_plots[plot_side] = json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder)
         result_plots[plot_side] = figure.to_dict()
+        if request.json.get('format') == 'bdata':
+            encode_typed_arrays(result_plots[plot_side])
 
-    highlight_groups = get_highlight_groups(tracks_meta)
+    highlight_groups = membership_index.get_highlight_groups(catalog.ids)
 
     return json.dumps({
         'plots': result_plots,
@@ -236,16 +308,63 @@ def plot_advanced():
     }, cls=plotly.utils.PlotlyJSONEncoder)
 
 
-@cache.memoize()
-def get_embeddings_and_project(model, tracks, sparse_factor):
-    if 'pca' in model.projection:
-        return model.get_embeddings(tracks, sparse_factor, [0, 1])
+DYNAMIC_PROJECTIONS = {
+    'tsne': (reduce_tsne, TSNE_PARAMS),
+    'umap': (reduce_umap, UMAP_PARAMS)
+}
+
+
+def get_projection_cache_key(model, tracks, sparse_factor):
+    """Key has everything that affects the projection, including the state of the aggregated embeddings"""
+    input_model = model.with_projection('pca')
+    input_stat = (Path(current_app.config['AGGRDATA_DIR']) / f'{input_model}.npy').stat()
+    transformer_file = get_transformer_file(model)
+    transformer_mtime = transformer_file.stat().st_mtime_ns if transformer_file.exists() else None
+    return get_projection_cache().get_key(
+        model=str(input_model),
+        input=[input_stat.st_ino, input_stat.st_mtime_ns, input_stat.st_size],
+        projection=model.projection,
+        params=DYNAMIC_PROJECTIONS[model.projection][1],
+        tracks=sorted(track.id for track in tracks),
+        sparse_factor=sparse_factor,
+        pca_dims=current_app.config['PCA_DIMS'],
+        transformer=transformer_mtime
+    )
+
+
+def submit_projection_job(model, tracks, sparse_factor) -> Optional[str]:
+    """Submits dynamic projection as a background job, returns None if no job is needed because it is cached or the
+    projection was fitted offline and only needs to be transformed"""
+    if model.projection not in DYNAMIC_PROJECTIONS or get_transformer_file(model).exists():
+        return None
+
+    key = get_projection_cache_key(model, tracks, sparse_factor)
+    if key in get_projection_cache():
+        return None
 
     embeddings = model.with_projection('pca').get_embeddings(
         tracks, sparse_factor, slice(current_app.config['PCA_DIMS']))
+    return jobs.submit_projection(key, model.projection, [track.id for track in tracks], embeddings)
 
-    if model.projection == 'tsne':
-        return reduce_tsne(embeddings)
 
-    if model.projection == 'umap':
-        return reduce_umap(embeddings)
+def get_embeddings_and_project(model, tracks, sparse_factor):
+    if model.projection not in DYNAMIC_PROJECTIONS:
+        return model.get_embeddings(tracks, sparse_factor, [0, 1])
+
+    projection_cache = get_projection_cache()
+    key = get_projection_cache_key(model, tracks, sparse_factor)
+    track_ids = [track.id for track in tracks]
+    embeddings = projection_cache.get(key, track_ids)
+    if embeddings is None:
+        embeddings = model.with_projection('pca').get_embeddings(
+            tracks, sparse_factor, slice(current_app.config['PCA_DIMS']))
+
+        transformer = get_transformer(model)
+        if transformer is not None:
+            embeddings = transform_generic(embeddings, transformer)
+        else:
+            reduce_func = DYNAMIC_PROJECTIONS[model.projection][0]
+            embeddings = reduce_func(embeddings)
+        projection_cache.put(key, track_ids, embeddings)
+
+    return embeddings
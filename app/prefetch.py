@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, TypeVar, Union
+
+import numpy as np
+from flask import current_app
+
+T = TypeVar('T')
+PathLike = Union[str, Path]
+
+
+def load_embeddings(path: PathLike) -> np.ndarray:
+    return np.load(str(path)).astype(np.float16)
+
+
+def read_shape(path: PathLike) -> tuple[int, ...]:
+    """Reads only the header of the .npy file"""
+    return np.load(str(path), mmap_mode='r').shape
+
+
+def prefetch(paths: Iterable[PathLike], load: Callable[[PathLike], T] = load_embeddings,
+             workers: Optional[int] = None, read_ahead: Optional[int] = None) -> Iterator[T]:
+    """
+    Loads files in a pool of threads and yields them in the order of paths. Up to read_ahead files are being loaded or
+    waiting for the consumer at a time, so memory stays bounded. Reading many small files is latency-bound on network
+    storage, and numpy releases the GIL while reading, so the threads overlap the waiting
+    """
+    workers = workers or current_app.config['EMBEDDINGS_READ_WORKERS']
+    read_ahead = max(read_ahead or current_app.config['EMBEDDINGS_READ_AHEAD'], workers)
+    paths = iter(paths)
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque(executor.submit(load, path) for path in islice(paths, read_ahead))
+        try:
+            while pending:
+                data = pending.popleft().result()
+                pending.extend(executor.submit(load, path) for path in islice(paths, 1))
+                yield data
+        finally:
+            for future in pending:  # consumer stopped early or loading failed
+                future.cancel()
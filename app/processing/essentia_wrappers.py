@@ -5,8 +5,9 @@ from pathlib import Path
 from typing import Optional
 
 import essentia.standard as ess
+import essentia.streaming as ess_streaming
 import numpy as np
-from essentia import Pool
+from essentia import Pool, run
 
 SAMPLE_RATE = 16000
 
@@ -24,25 +25,59 @@ def get_predictors(models_dir: Path, architectures: dict) -> dict:
     return predictors
 
 
-def get_melspecs(audio_file: Path, algorithms: dict) -> Optional[dict[str, np.ndarray]]:
-    # loading file
+def load_audio(audio_file: Path) -> Optional[np.ndarray]:
     try:
-        audio = ess.MonoLoader(filename=str(audio_file), sampleRate=SAMPLE_RATE)()
+        return ess.MonoLoader(filename=str(audio_file), sampleRate=SAMPLE_RATE)()
     except RuntimeError:
         logging.error(f'Error reading file: {audio_file}')
         return None
 
+
+def compute_melspecs_frames(audio: np.ndarray, parameters: dict) -> np.ndarray:
+    """Calls melspec algorithm for every frame from Python"""
+    melspec_extractor = getattr(ess, parameters['melspec-algorithm'])()
+    melspecs = []
+    for frame in ess.FrameGenerator(audio, frameSize=parameters['frame-size'], hopSize=parameters['hop-size']):
+        melspecs.append(melspec_extractor(frame))
+
+    return np.array(melspecs)
+
+
+def compute_melspecs_streaming(audio: np.ndarray, parameters: dict) -> np.ndarray:
+    """Same as compute_melspecs_frames, but framing and melspecs of the whole signal are computed by essentia streaming
+    network without going back to Python for every frame. FrameCutter has the same defaults as FrameGenerator"""
+    vector_input = ess_streaming.VectorInput(audio)
+    frame_cutter = ess_streaming.FrameCutter(frameSize=parameters['frame-size'], hopSize=parameters['hop-size'])
+    melspec_extractor = getattr(ess_streaming, parameters['melspec-algorithm'])()
+    pool = Pool()
+
+    vector_input.data >> frame_cutter.signal
+    frame_cutter.frame >> melspec_extractor.frame
+    melspec_extractor.bands >> (pool, 'melspecs')
+    run(vector_input)
+
+    if 'melspecs' not in pool.descriptorNames():
+        return np.array([])
+    return np.array(pool['melspecs'])
+
+
+MELSPEC_METHODS = {
+    'frames': compute_melspecs_frames,
+    'streaming': compute_melspecs_streaming
+}
+
+
+def get_melspecs(audio_file: Path, algorithms: dict, method: str = 'streaming') -> Optional[dict[str, np.ndarray]]:
+    # loading file
+    audio = load_audio(audio_file)
+    if audio is None:
+        return None
+
     # precompute melspecs
     melspecs_all = {}
     for algorithm_name in algorithms:
         parameters = algorithms[algorithm_name]
-
-        melspec_extractor = getattr(ess, parameters['melspec-algorithm'])()
-        melspecs = []
-        for frame in ess.FrameGenerator(audio, frameSize=parameters['frame-size'], hopSize=parameters['hop-size']):
-            melspecs.append(melspec_extractor(frame))
-
-        melspecs = np.array(melspecs)
+        melspecs = MELSPEC_METHODS[method](audio, parameters)
 
         # reshape melspecs into tensor batches and discard the remainder
         discard = melspecs.shape[0] % parameters['patch-size']
@@ -56,28 +91,87 @@ def get_melspecs(audio_file: Path, algorithms: dict) -> Optional[dict[str, np.nd
     return melspecs_all
 
 
-def get_embeddings(melspecs: dict[str, np.ndarray], architectures: dict, predictors: dict) -> Optional[dict]:
-    data = {}
-    for architecture, metadata in architectures.items():
+def predict(predictor, melspecs: np.ndarray, output_layers: list[str], max_patches: Optional[int] = None) -> dict:
+    """
+    Runs predictor on chunks of at most max_patches patches and concatenates the outputs, so the memory used by the
+    model doesn't grow with the duration of the track. All patches are passed at once if max_patches is None
+    :raises RuntimeError: prediction failed or there are no patches
+    """
+    if len(melspecs) == 0:
+        raise RuntimeError('No patches to predict')
+
+    max_patches = max_patches or len(melspecs)
+    outputs = {layer: [] for layer in output_layers}
+    for start in range(0, len(melspecs), max_patches):
         input_pool = Pool()
-        input_pool.set('model/Placeholder', melspecs[metadata['essentia-algorithm']])
+        input_pool.set('model/Placeholder', melspecs[start:start + max_patches])
+        output_pool = predictor(input_pool)
+        for layer in output_layers:
+            outputs[layer].append(output_pool[layer])
+
+    return {layer: np.concatenate(chunks) for layer, chunks in outputs.items()}
 
+
+def _get_output_layers(metadata: dict) -> list[str]:
+    return [layer_data['name'] for layer_data in metadata['layers'].values()]
+
+
+def get_embeddings(melspecs: dict[str, np.ndarray], architectures: dict, predictors: dict,
+                   max_patches: Optional[int] = None) -> Optional[dict]:
+    data = {}
+    for architecture, metadata in architectures.items():
         for dataset in metadata['datasets']:
-            # TODO: chunk the input melspecs to avoid OOM error
             try:
-                output_pool = predictors[f'{dataset}-{architecture}'](input_pool)
+                outputs = predict(predictors[f'{dataset}-{architecture}'], melspecs[metadata['essentia-algorithm']],
+                                  _get_output_layers(metadata), max_patches)
             except RuntimeError:
                 return None
 
             for layer, layer_data in metadata['layers'].items():
-                embeddings = output_pool[layer_data['name']].squeeze()
+                embeddings = _squeeze(outputs[layer_data['name']])
 
                 if len(embeddings) == 0:
                     return None
 
-                if len(embeddings.shape) == 1:
-                    embeddings = np.expand_dims(embeddings, axis=0)
-
                 data[f'{dataset}-{architecture}-{layer}'] = embeddings
 
     return data
+
+
+def _squeeze(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = embeddings.squeeze()
+    if len(embeddings.shape) == 1:
+        embeddings = np.expand_dims(embeddings, axis=0)
+    return embeddings
+
+
+def get_embeddings_batch(melspecs_batch: list[dict[str, np.ndarray]], architectures: dict, predictors: dict,
+                         max_patches: Optional[int] = None) -> list[Optional[dict]]:
+    """Same as get_embeddings for many tracks, but patches of all the tracks go through each predictor in one call. If
+    the batch fails, tracks are predicted one by one, so only the failing ones are None"""
+    results = [{} if all(len(melspecs) > 0 for melspecs in track_melspecs.values()) else None
+               for track_melspecs in melspecs_batch]
+    valid_melspecs = [melspecs for melspecs, result in zip(melspecs_batch, results) if result is not None]
+    valid_results = [result for result in results if result is not None]
+    if not valid_melspecs:
+        return results
+
+    for architecture, metadata in architectures.items():
+        batch = [melspecs[metadata['essentia-algorithm']] for melspecs in valid_melspecs]
+        splits = np.cumsum([len(melspecs) for melspecs in batch])[:-1]
+        batch = np.concatenate(batch)
+
+        for dataset in metadata['datasets']:
+            try:
+                outputs = predict(predictors[f'{dataset}-{architecture}'], batch, _get_output_layers(metadata),
+                                  max_patches)
+            except RuntimeError:
+                logging.warning(f'Batch of {len(melspecs_batch)} tracks failed, predicting them one by one')
+                return [get_embeddings(melspecs, architectures, predictors, max_patches) if result is not None
+                        else None for melspecs, result in zip(melspecs_batch, results)]
+
+            for layer, layer_data in metadata['layers'].items():
+                for result, embeddings in zip(valid_results, np.split(outputs[layer_data['name']], splits)):
+                    result[f'{dataset}-{architecture}-{layer}'] = _squeeze(embeddings)
+
+    return results
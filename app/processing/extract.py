@@ -1,5 +1,13 @@
 import logging
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
+from time import perf_counter
+from typing import Dict
 
 import click
 import numpy as np
@@ -7,7 +15,8 @@ from flask import current_app
 from flask.cli import with_appcontext
 from tqdm import tqdm
 
-from app.database.base import Track
+from app.database.base import Track, db, needs_committing, remove_stale_segmentations
+from app.database.manifest import Extraction, Manifest, get_audio_signature, hash_file
 from app.models import get_models
 
 
@@ -39,56 +48,277 @@ def extract(input_dir, output_dir, algorithm, model_file, layer, accumulate=Fals
     logging.info('Done!')
 
 
-def _already_extracted(track, models, data_root):
-    for model in models.get_combinations():
-        embeddings_file = data_root / str(model) / track.get_embeddings_filename()
+def _count_patches(melspecs: Dict[str, np.ndarray]) -> int:
+    return max(len(batch) for batch in melspecs.values())
+
+
+def _already_extracted(track, model_names, data_root):
+    for model_name in model_names:
+        embeddings_file = data_root / model_name / track.get_embeddings_filename()
         if not embeddings_file.exists():
             return False
 
     return True
 
 
-def extract_all(models_dir, dry=False, force=False):
-    # TODO: incorporate dry properly
-    from app.processing.essentia_wrappers import get_embeddings, get_melspecs, get_predictors
+@dataclass
+class StageStats:
+    """Throughput of one stage of extract_all, busy time is summed over the workers of the stage"""
+    name: str
+    unit: str
+    items: int = 0
+    busy_time: float = 0
+
+    def add(self, items: int, busy_time: float):
+        self.items += items
+        self.busy_time += busy_time
+
+    def report(self, total_time: float):
+        logging.info(f'{self.name}: {self.items} {self.unit} in {self.busy_time:.1f} s busy, '
+                     f'{self.items / total_time:.1f} {self.unit}/s overall')
+
+
+def _decode(audio_file: Path, algorithms: dict):
+    """Runs in the decode pool: loads audio and computes melspecs"""
+    from app.processing.essentia_wrappers import get_melspecs
+    start = perf_counter()
+    melspecs = get_melspecs(audio_file, algorithms)
+    return melspecs, perf_counter() - start
+
+
+def _write(write_queue: queue.Queue, written: list, data_root_dir: Path, stats: StageStats, lock: threading.Lock):
+    """Runs in the writer threads until None is received, saved tracks are appended to written to be recorded in the
+    manifest by the main thread. Tracks that can't be saved are recorded as failed, and the thread keeps draining the
+    queue, so that the main thread never blocks on it"""
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+
+        track_id, audio_signature, embeddings_filename, embeddings = item
+        start = perf_counter()
+        n_rows = {}
+        try:
+            for model_name, embedding in embeddings.items():
+                embeddings_file = data_root_dir / model_name / embeddings_filename
+                embeddings_file.parent.mkdir(parents=True, exist_ok=True)
+                np.save(embeddings_file, embedding.astype(np.float16))
+                n_rows[model_name] = len(embedding)
+            result = (track_id, audio_signature, n_rows)
+        except Exception:
+            logging.exception(f'Error writing embeddings: {embeddings_filename}')
+            result = (track_id, audio_signature, {}, Extraction.FAILED)
+        with lock:
+            stats.add(len(n_rows), perf_counter() - start)
+            written.append(result)
+
+
+def _remove_stale_segmentations(models: list, extracted: Dict[int, Dict[str, int]]):
+    """Tracks that were extracted again can have different number of segments, their segmentations are removed, so
+    that aggregate-all and index-all-embeddings put them after all the other tracks"""
+    for length in sorted({model.length for model in models}):
+        name = next(str(model) for model in models if model.length == length)
+        n_segments = {track_id: n_rows[name] for track_id, n_rows in extracted.items() if name in n_rows}
+        stale = remove_stale_segmentations(length, n_segments)
+        if stale:
+            logging.warning(f'Number of segments of length {length} changed for {len(stale)} tracks, the segment ids '
+                            f'changed, so run aggregate-all and index-all-embeddings -f')
+
+
+def _get_tracks_to_extract(manifest: Manifest, model_hashes: Dict[str, str], audio_dir: Path, data_root_dir: Path,
+                           force: bool, dry: bool = False) -> list:
+    """Returns tracks with audio signatures that are new or changed since the last run according to the manifest.
+    Tracks extracted before the manifest existed are recorded as they are, unless it is a dry run"""
+    tracks = []
+    for track in tqdm(db.session.query(Track).all(), desc='Checking manifest'):
+        audio_signature = get_audio_signature(audio_dir / track.path)
+        if force or not all(manifest.is_current(track.id, name, audio_signature, model_hash)
+                            for name, model_hash in model_hashes.items()):
+            if not force and not manifest.has_track(track.id) \
+                    and _already_extracted(track, model_hashes, data_root_dir):
+                if dry:
+                    continue
+                for name, model_hash in model_hashes.items():
+                    embeddings = np.load(data_root_dir / name / track.get_embeddings_filename(), mmap_mode='r')
+                    manifest.record(track.id, name, audio_signature, model_hash, len(embeddings))
+            else:
+                tracks.append((track, audio_signature))
+    if not dry:
+        db.session.commit()
+    return tracks
+
+
+def extract_all(models_dir, dry=False, force=False, decode_workers=None, write_workers=None, batch_patches=None,
+                max_patches=None):
+    """
+    Pipeline of three stages connected with bounded queues: decode pool computes melspecs in separate processes,
+    predictor in this process runs the models on the patches of several tracks at once, and writer threads save the
+    embeddings. Only tracks that are new or changed according to the manifest are extracted, tracks that can't be
+    decoded or predicted are recorded as failed and skipped by the other commands
+    """
+    from app.processing.essentia_wrappers import get_embeddings_batch, get_predictors
     app = current_app
     audio_dir = Path(app.config['AUDIO_DIR'])
     data_root_dir = Path(app.config['DATA_DIR'])
     models_dir = Path(models_dir)
+    decode_workers = decode_workers or app.config['EXTRACT_DECODE_WORKERS']
+    write_workers = write_workers or app.config['EXTRACT_WRITE_WORKERS']
+    batch_patches = batch_patches or app.config['EXTRACT_BATCH_PATCHES']
+    max_patches = max_patches or app.config['EXTRACT_MAX_PATCHES']
+    queue_size = app.config['EXTRACT_QUEUE_SIZE']
 
     models = get_models()
-    predictors = get_predictors(models_dir, models.data['architectures'])
+    combinations = list(models.get_combinations())
+    algorithms = models.data['algorithms']
+    architectures = models.data['architectures']
+    predictors = get_predictors(models_dir, architectures)
 
-    tracks_to_delete = []
-    for track in tqdm(Track.get_all()):
-        audio_file = audio_dir / track.path
+    logging.info('Hashing model files...')
+    predictor_hashes = {name: hash_file(models_dir / f'{name}.pb') for name in predictors}
+    model_hashes = {str(model): predictor_hashes[f'{model.dataset}-{model.architecture}']
+                    for model in combinations}
+    manifest = Manifest(model_hashes.keys())
 
-        if force or not _already_extracted(track, models, data_root_dir):
-            melspecs = get_melspecs(audio_file, models.data['algorithms'])
-            if melspecs is None:
-                tracks_to_delete.append(track)
-            else:
-                embeddings = get_embeddings(melspecs, models.data['architectures'], predictors)
-                if embeddings is None:
-                    tracks_to_delete.append(track)
-                else:
-                    for model_name, embedding in embeddings.items():
-                        embeddings_file = data_root_dir / model_name / track.get_embeddings_filename()
-                        if force or not embeddings_file.exists():
-                            embeddings_file.parent.mkdir(parents=True, exist_ok=True)
-                            np.save(embeddings_file, embedding.astype(np.float16))
-
-    for track in tracks_to_delete:
-        track.delete()
-
-    # extract(
-    #     audio_dir,
-    #     data_root_dir / str(model),
-    #     model.architecture_data['essentia-algorithm'],
-    #     models_dir / f'{model.dataset}-{model.architecture}.pb',
-    #     model.layer_data['name'],
-    #     accumulate, dry, force
-    # )
+    tracks = _get_tracks_to_extract(manifest, model_hashes, audio_dir, data_root_dir, force, dry)
+    logging.info(f'Extracting {len(tracks)} tracks')
+
+    decode_stats = StageStats('Decode', 'tracks')
+    predict_stats = StageStats('Predict', 'patches')
+    write_stats = StageStats('Write', 'files')
+    write_lock = threading.Lock()
+    write_queue = queue.Queue(queue_size)
+    written = []
+    extracted = {}  # number of rows of each model for the tracks that were saved
+    writers = [threading.Thread(target=_write, args=(write_queue, written, data_root_dir, write_stats, write_lock))
+               for _ in range(write_workers)]
+    for writer in writers:
+        writer.start()
+
+    session_size = 0
+    start_time = perf_counter()
+    progress = tqdm(total=len(tracks))
+
+    def record(track_id, audio_signature, n_rows: dict, status=Extraction.DONE):
+        nonlocal session_size
+        if dry:
+            return
+        for name, model_hash in model_hashes.items():
+            manifest.record(track_id, name, audio_signature, model_hash, n_rows.get(name, 0), status)
+        if status == Extraction.DONE:
+            extracted[track_id] = n_rows
+        session_size += 1
+        if needs_committing(session_size):
+            db.session.commit()
+            session_size = 0
+
+    def record_written():
+        with write_lock:
+            items = written[:]
+            written.clear()
+        for item in items:
+            record(*item)
+
+    def predict(batch):
+        start = perf_counter()
+        results = get_embeddings_batch([melspecs for *_, melspecs in batch], architectures, predictors, max_patches)
+        predict_stats.add(sum(_count_patches(melspecs) for *_, melspecs in batch), perf_counter() - start)
+
+        for (track, audio_signature, _), embeddings in zip(batch, results):
+            if embeddings is None:
+                record(track.id, audio_signature, {}, Extraction.FAILED)
+            elif not dry:
+                write_queue.put((track.id, audio_signature, track.get_embeddings_filename(), embeddings))
+        progress.update(len(batch))
+        record_written()
+
+    try:
+        with ProcessPoolExecutor(decode_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            remaining = iter(tracks)
+            pending = deque()
+
+            def submit_next():
+                track, audio_signature = next(remaining, (None, None))
+                if track is not None:
+                    pending.append((track, audio_signature, pool.submit(_decode, audio_dir / track.path, algorithms)))
+
+            for _ in range(queue_size):
+                submit_next()
+
+            batch, batch_size = [], 0
+            while pending:
+                track, audio_signature, future = pending.popleft()
+                melspecs, decode_time = future.result()
+                submit_next()
+                decode_stats.add(1, decode_time)
+
+                if melspecs is None:
+                    record(track.id, audio_signature, {}, Extraction.FAILED)
+                    progress.update()
+                    continue
+
+                batch.append((track, audio_signature, melspecs))
+                batch_size += _count_patches(melspecs)
+                if batch_size >= batch_patches:
+                    predict(batch)
+                    batch, batch_size = [], 0
+
+            if batch:
+                predict(batch)
+    finally:
+        for _ in writers:
+            write_queue.put(None)
+        for writer in writers:
+            writer.join()
+        progress.close()
+        record_written()
+        db.session.commit()
+    if not dry:
+        _remove_stale_segmentations(combinations, extracted)
+
+    total_time = perf_counter() - start_time
+    for stats in [decode_stats, predict_stats, write_stats]:
+        stats.report(total_time)
+
+    n_failed = len(manifest.get_rows(next(iter(model_hashes)), Extraction.FAILED)) if model_hashes else 0
+    logging.info(f'{n_failed} tracks failed in total, they are skipped until their audio changes')
+
+
+def compare_melspecs(n_tracks=10):
+    """Checks that all methods of computing melspecs give identical output on random tracks and reports their timing"""
+    from app.processing.essentia_wrappers import MELSPEC_METHODS, load_audio
+    audio_dir = Path(current_app.config['AUDIO_DIR'])
+    algorithms = get_models().data['algorithms']
+
+    timings = {method: [] for method in MELSPEC_METHODS}
+    mismatches = 0
+    for track in tqdm(Track.get_all(limit=n_tracks, random=True)):
+        audio = load_audio(audio_dir / track.path)
+        if audio is None:
+            continue
+
+        for algorithm_name, parameters in algorithms.items():
+            results = {}
+            for method, compute_melspecs in MELSPEC_METHODS.items():
+                start = perf_counter()
+                results[method] = compute_melspecs(audio, parameters)
+                timings[method].append(perf_counter() - start)
+
+            reference = results['frames']
+            for method, melspecs in results.items():
+                if not np.array_equal(melspecs, reference):
+                    mismatches += 1
+                    difference = np.abs(melspecs - reference).max() if melspecs.shape == reference.shape else None
+                    logging.error(f'{method} differs for {track.path} with {algorithm_name}: shapes {melspecs.shape} '
+                                  f'and {reference.shape}, max difference {difference}')
+
+    for method, method_timings in timings.items():
+        if method_timings:
+            logging.info(f'{method}: {np.mean(method_timings) * 1000:.1f} ms per track and algorithm')
+
+    if mismatches:
+        logging.error(f'{mismatches} mismatches')
+        exit(1)
+    logging.info('All methods are identical')
 
 
 # Entry points
@@ -114,8 +344,22 @@ def extract_command(input_dir, output_dir, algorithm, model_file, layer, accumul
 @click.argument('models_dir', type=click.Path(exists=True))
 @click.option('-d', '--dry', is_flag=True, help='simulate the run')
 @click.option('-f', '--force', is_flag=True, help='force overwriting of embedding files')
+@click.option('-w', '--decode-workers', type=int, help='number of decoding processes (default: EXTRACT_DECODE_WORKERS)')
+@click.option('--write-workers', type=int, help='number of writing threads (default: EXTRACT_WRITE_WORKERS)')
+@click.option('-b', '--batch-patches', type=int, help='number of patches to predict at once (default: '
+                                                      'EXTRACT_BATCH_PATCHES)')
+@click.option('-m', '--max-patches', type=int, help='max number of patches per model call (default: '
+                                                    'EXTRACT_MAX_PATCHES)')
 @with_appcontext
-def extract_all_command(models_dir, dry, force):
+def extract_all_command(models_dir, dry, force, decode_workers, write_workers, batch_patches, max_patches):
     """Compute all embeddings according to config file. Expects MODELS_DIR to have all dataset-model files inside named
     accordingly (e.g. mtt-musicnn.pb)"""
-    extract_all(models_dir, dry, force)
+    extract_all(models_dir, dry, force, decode_workers, write_workers, batch_patches, max_patches)
+
+
+@click.command('compare-melspecs')
+@click.option('-n', '--n-tracks', type=int, default=10, help='number of random tracks to compare on')
+@with_appcontext
+def compare_melspecs_command(n_tracks):
+    """Compare melspecs computed frame by frame and with essentia streaming network, and time both"""
+    compare_melspecs(n_tracks)
@@ -1,60 +1,126 @@
 import logging
-from glob import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
 from pathlib import Path
+from typing import Dict, Iterable, List, Set
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
-from tqdm import tqdm
 
-from app.database.base import Track, db, needs_committing
+from app.database.base import Segmentation, Track, bulk_insert, compact_segmentations, db
+from app.database.manifest import Extraction
+from app.database.membership import reset_membership_index
+from app.database.metadata import TrackMetadata, track_metadata_tag_table
 
 
-def index_audio(input_dir, wildcards):
+def _matches(name: str, wildcards: Iterable[str]) -> bool:
+    return any(fnmatchcase(name, wildcard) for wildcard in wildcards)
+
+
+def _scan_tree(directory: str, prefix: str, wildcards: Iterable[str]) -> List[str]:
+    """Returns paths relative to the audio dir of all matching files in the directory tree, hidden files and
+    directories are skipped like with glob"""
+    paths = []
+    stack = [(directory, prefix)]
+    while stack:
+        directory, prefix = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    stack.append((entry.path, f'{prefix}{entry.name}/'))
+                elif _matches(entry.name, wildcards):
+                    paths.append(prefix + entry.name)
+    return paths
+
+
+def scan_audio(input_dir: Path, wildcards: Iterable[str], threads=1) -> Set[str]:
+    """Walks the directory with os.scandir, top-level directories are scanned in parallel by a pool of threads"""
+    paths = set()
+    directories = []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                directories.append(entry)
+            elif _matches(entry.name, wildcards):
+                paths.add(entry.name)
+
+    with ThreadPoolExecutor(threads) as pool:
+        for tree_paths in pool.map(lambda entry: _scan_tree(entry.path, f'{entry.name}/', wildcards), directories):
+            paths.update(tree_paths)
+    return paths
+
+
+def prune_tracks(track_ids: List[int]):
+    """Removes the tracks together with their segmentations, metadata and manifest rows"""
+    batch_size = current_app.config['DB_COMMIT_BATCH_SIZE']
+    for pos in range(0, len(track_ids), batch_size):
+        batch = track_ids[pos:pos + batch_size]
+        db.session.execute(track_metadata_tag_table.delete().where(track_metadata_tag_table.c.track_id.in_(batch)))
+        for model in [TrackMetadata, Extraction, Segmentation, Track]:
+            db.session.query(model).filter(model.id.in_(batch)).delete(synchronize_session=False)
+        db.session.commit()
+    compact_segmentations()
+    reset_membership_index()
+
+
+def index_audio(input_dir, wildcards, prune=False, threads=1):
+    """
+    Adds new audio files to the database with one bulk insert. Indexed tracks whose files are gone are reported, and
+    removed with prune
+    """
     input_dir = Path(input_dir)
-    audio_files = []
-    for wildcard in wildcards:
-        audio_files += glob(str(input_dir / '**' / wildcard), recursive=True)
-    audio_files = sorted(audio_files)
+    logging.info(f'Indexing audio in {input_dir}')
+    audio_files = scan_audio(input_dir, wildcards, threads)
     if len(audio_files) == 0:
         logging.error(f'No {wildcards} files found in {input_dir}')
         exit(1)
     logging.debug(f'Found {len(audio_files)} audio files')
 
-    session_size = 0
-    logging.info(f'Indexing audio in {input_dir}')
-    for audio_file in tqdm(audio_files):
-        relative_path = str(Path(audio_file).relative_to(input_dir))
-        if Track.get_by_path(relative_path) is None:
-            track = Track(path=str(relative_path))
-            db.session.add(track)
-            session_size += 1
-
-            if needs_committing(session_size):
-                db.session.commit()
-                session_size = 0
-
-    db.session.commit()
+    indexed: Dict[str, int] = dict(db.session.query(Track.path, Track.id))
+    new_files = sorted(audio_files - indexed.keys())
+    logging.info(f'Adding {len(new_files)} new tracks')
+    bulk_insert(Track, [{'path': path} for path in new_files])
+
+    # tracks that don't match the wildcards were indexed on purpose with other ones
+    vanished = sorted(path for path in indexed.keys() - audio_files if _matches(Path(path).name, wildcards))
+    if vanished:
+        logging.debug(f'Missing audio files: {vanished}')
+        if not prune:
+            logging.warning(f'{len(vanished)} indexed tracks have no audio file, use --prune to remove them')
+        else:
+            prune_tracks([indexed[path] for path in vanished])
+            logging.warning(f'Removed {len(vanished)} tracks without audio file, the segment ids changed, so run '
+                            f'aggregate-all and index-all-embeddings -f')
     logging.info('Done!')
 
 
-def index_all_audio(wildcards):
+def index_all_audio(wildcards, prune=False, threads=1):
     audio_dir = Path(current_app.config['AUDIO_DIR'])
-    index_audio(audio_dir, wildcards)
+    index_audio(audio_dir, wildcards, prune, threads)
 
 
 @click.command('index-audio')
 @click.argument('input_dir', type=click.Path(exists=True))
 @click.option('-w', '--wildcards', default=['*.mp3', '*.flac'], multiple=True,
               help='wildcards that describes the audio files (e.g. *.mp3)')
+@click.option('-p', '--prune', is_flag=True, help='remove tracks whose audio files don\'t exist anymore')
+@click.option('-t', '--threads', type=int, default=1, help='number of top-level directories scanned in parallel')
 @with_appcontext
-def index_audio_command(input_dir, wildcards: tuple):
-    index_audio(input_dir, wildcards)
+def index_audio_command(input_dir, wildcards: tuple, prune, threads):
+    index_audio(input_dir, wildcards, prune, threads)
 
 
 @click.command('index-all-audio')
 @click.option('-w', '--wildcards', default=['*.mp3', '*.flac'], multiple=True,
               help='wildcards that describes the audio files (e.g. *.mp3)')
+@click.option('-p', '--prune', is_flag=True, help='remove tracks whose audio files don\'t exist anymore')
+@click.option('-t', '--threads', type=int, default=1, help='number of top-level directories scanned in parallel')
 @with_appcontext
-def index_all_audio_command(wildcards):
-    index_all_audio(wildcards)
+def index_all_audio_command(wildcards, prune, threads):
+    index_all_audio(wildcards, prune, threads)
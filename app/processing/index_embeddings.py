@@ -1,67 +1,262 @@
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from time import perf_counter
+from typing import Tuple
 
 import click
+import numpy as np
+from annoy import AnnoyIndex
+from flask import current_app
 from flask.cli import with_appcontext
 from tqdm import tqdm
 
-from app.database.base import Segmentation, Track, db, needs_committing
+from app.database.base import Segmentation, SegmentResolver, Track, db, needs_committing, reset_segment_resolvers
+from app.database.manifest import Extraction, Manifest
 from app.models import get_models
 
+ADD_CHUNK_SIZE = 10000  # rows of aggregated embeddings that are converted at a time
 
-def index_embeddings(model, n_trees=16, n_tracks=None, dry=False, force=False):
-    embeddings_index = model.get_annoy_index(load=False)
 
-    if model.index_file.exists() and not force:
-        print(f'Index {model.index_file} already exists, skipping')
-        return
-
-    current_index = 0
+def _add_tracks(index: AnnoyIndex, model, tracks, offset=0, dry=False):
+    """
+    Adds embeddings of the tracks to the index with item ids = segment ids - offset. Tracks keep their segment ids if
+    they have segmentation, otherwise they get the next free ones after all existing segments
+    """
+    resolver = SegmentResolver.from_db(model.length)
+    start_ids = dict(zip(resolver.track_ids.tolist(), resolver.start_ids.tolist()))
+    next_id = resolver.total
     session_size = 0
 
-    logging.info(f'Loading {model}...')
-    for track in tqdm(Track.get_all(limit=n_tracks)):
-        embeddings = track.get_embeddings_from_file(model.data_dir)
+    tracks = resolver.sort_tracks(tracks)
+    for track, embeddings in zip(tracks, tqdm(model.iter_embeddings_from_file(tracks), total=len(tracks))):
 
         if len(embeddings.shape) < 2:
             logging.error(f'Irregular embeddings for track {track}!')
             exit(1)
 
-        total_segments = len(embeddings)
+        start_id = start_ids.get(track.id)
+        if start_id is None:
+            start_id = next_id
+            next_id += len(embeddings)
+            db.session.add(Segmentation(track=track, length=model.length, start_id=start_id,
+                                        stop_id=start_id + len(embeddings)))
+            session_size += 1
 
         for position, embedding in enumerate(embeddings):
-            embeddings_index.add_item(current_index + position, embedding)  # annoy
-
-        if not track.has_segmentation(model.length):
-            db.session.add(Segmentation(track=track, length=model.length, start_id=current_index,
-                                        stop_id=current_index + total_segments))
-            session_size += 1
+            index.add_item(start_id + position - offset, embedding)  # annoy
 
         if not dry and needs_committing(session_size):
             db.session.commit()
             session_size = 0
 
-        current_index += total_segments
-
     if not dry:
         db.session.commit()  # commit remaining tracks in session
+        reset_segment_resolvers()
+
+
+def _save_index(index: AnnoyIndex, index_file):
+    """Saves to temporary file first, so the app never loads partially written index"""
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = index_file.with_suffix('.tmp')
+    index.save(str(tmp_file))
+    os.replace(tmp_file, index_file)
+
+
+def index_embeddings(model, n_trees=16, n_tracks=None, dry=False, force=False):
+    embeddings_index = model.get_annoy_index(load=False)
+
+    if model.index_file.exists() and not force:
+        print(f'Index {model.index_file} already exists, skipping')
+        return
+
+    logging.info(f'Loading {model}...')
+    _add_tracks(embeddings_index, model, Track.get_all(limit=n_tracks), dry=dry)
 
     logging.info('Building index...')
     embeddings_index.build(n_trees, n_jobs=-1)
 
     if not dry:
-        model.index_file.parent.mkdir(parents=True, exist_ok=True)
-        embeddings_index.save(str(model.index_file))
+        if model.delta_index_file.exists():
+            model.delta_index_file.unlink()
+        _save_index(embeddings_index, model.index_file)
 
     logging.info('Done!')
 
 
-def index_all_embeddings(n_trees=16, n_tracks=None, dry=False, force=False):
+def index_embeddings_incremental(model, n_trees=16, dry=False):
+    """
+    New tracks get segment ids after the last existing one, and all the segments that are not in the base index go to
+    the delta index, which is small, so it is rebuilt from scratch every time. The app queries both
+    """
+    if not model.index_file.exists():
+        logging.info(f'No base index for {model}, building the full index')
+        index_embeddings(model, n_trees, dry=dry)
+        return
+
+    distance = current_app.config['ANNOY_DISTANCE']
+    base_index = AnnoyIndex(model.n_dimensions, distance)
+    base_index.load(str(model.index_file))
+    offset = base_index.get_n_items()
+    base_index.unload()
+
+    # new tracks, and also tracks that were segmented while indexing other model with the same segment length
+    all_tracks = Track.get_all()
+    resolver = SegmentResolver.from_db(model.length)
+    indexed = set(resolver.track_ids[resolver.stop_ids <= offset].tolist())
+    tracks = [track for track in all_tracks if track.id not in indexed]
+    if not tracks:
+        logging.info(f'{model} is up to date')
+        return
+
+    logging.info(f'Adding {len(tracks)} tracks of {model} to delta index...')
+    delta_index = AnnoyIndex(model.n_dimensions, distance)
+    _add_tracks(delta_index, model, tracks, offset, dry)
+
+    logging.info(f'Building delta index with {delta_index.get_n_items()} items...')
+    delta_index.build(n_trees, n_jobs=-1)
+    if not dry:
+        _save_index(delta_index, model.delta_index_file)
+
+    logging.info('Done!')
+
+
+def compact_index(model, n_trees=16):
+    """
+    Folds the delta index into the base index. Can be run while the app is running: loaded indexes stay valid, the
+    delta is removed before the base is replaced, so the app never combines new base with the old delta
+    """
+    if not model.delta_index_file.exists():
+        logging.info(f'No delta index for {model}, skipping')
+        return
+
+    distance = current_app.config['ANNOY_DISTANCE']
+    base_index = AnnoyIndex(model.n_dimensions, distance)
+    base_index.load(str(model.index_file))
+    delta_index = AnnoyIndex(model.n_dimensions, distance)
+    delta_index.load(str(model.delta_index_file))
+    offset = base_index.get_n_items()
+
+    logging.info(f'Compacting {model}: {offset} + {delta_index.get_n_items()} items...')
+    index = AnnoyIndex(model.n_dimensions, distance)
+    for i in tqdm(range(offset)):
+        index.add_item(i, base_index.get_item_vector(i))
+    for i in range(delta_index.get_n_items()):
+        index.add_item(offset + i, delta_index.get_item_vector(i))
+
+    logging.info('Building index...')
+    index.build(n_trees, n_jobs=-1)
+    model.delta_index_file.unlink()
+    _save_index(index, model.index_file)
+    logging.info('Done!')
+
+
+def segment_tracks(models, tracks, dry=False):
+    """
+    Creates segmentations for the tracks that don't have them yet with one bulk insert per segment length, in the same
+    order as aggregate-all puts them. Number of segments is taken from the manifest, or from the embeddings file header
+    """
+    for length in sorted({model.length for model in models}):
+        model = next(model for model in models if model.length == length)
+        resolver = SegmentResolver.from_db(length)
+        segmented = set(resolver.track_ids.tolist())
+        manifest = Manifest([str(model)])
+
+        next_id = resolver.total
+        segmentations = []
+        for track in resolver.sort_tracks(tracks):
+            if track.id in segmented:
+                continue
+            row = manifest.get(track.id, str(model))
+            if row is not None and row.status == Extraction.DONE:
+                n_segments = row.n_rows
+            else:
+                n_segments = len(np.load(model.data_dir / track.get_embeddings_filename(), mmap_mode='r'))
+            segmentations.append({'id': track.id, 'length': length, 'start_id': next_id,
+                                  'stop_id': next_id + n_segments})
+            next_id += n_segments
+
+        logging.info(f'Adding {len(segmentations)} segmentations of length {length}')
+        if segmentations and not dry:
+            db.session.bulk_insert_mappings(Segmentation, segmentations)
+            db.session.commit()
+    if not dry:
+        reset_segment_resolvers()
+
+
+def build_index(aggrdata_file: str, index_file: str, delta_index_file: str, n_dimensions: int, distance: str,
+                n_trees: int, n_jobs: int, dry: bool) -> Tuple[int, float, float]:
+    """Runs in the pool process: indexes all rows of the aggregated embeddings, row number is the segment id. Returns
+    number of items, time of adding the items and time of building the index"""
+    embeddings = np.load(aggrdata_file, mmap_mode='r')
+    index = AnnoyIndex(n_dimensions, distance)
+
+    start = perf_counter()
+    for chunk_start in range(0, len(embeddings), ADD_CHUNK_SIZE):
+        chunk = embeddings[chunk_start:chunk_start + ADD_CHUNK_SIZE].astype(np.float32).tolist()
+        for i, vector in enumerate(chunk, chunk_start):
+            index.add_item(i, vector)
+    add_time = perf_counter() - start
+
+    start = perf_counter()
+    index.build(n_trees, n_jobs=n_jobs)
+    build_time = perf_counter() - start
+
+    if not dry:
+        if os.path.exists(delta_index_file):
+            os.unlink(delta_index_file)
+        _save_index(index, Path(index_file))
+    return len(embeddings), add_time, build_time
+
+
+def index_all_embeddings_parallel(n_trees=16, dry=False, force=False, workers=None):
+    """
+    Builds indexes from the aggregated embeddings (run aggregate-all first) with one model per process. Segmentations
+    are created beforehand in the same order, so rows of the aggregated files are the segment ids
+    """
+    app = current_app
+    workers = workers or app.config['INDEX_WORKERS']
+    models = [model for model in get_models().get_combinations() if force or not model.index_file.exists()]
+    if not models:
+        logging.info('All indexes exist, skipping')
+        return
+
+    segment_tracks(models, Track.get_all(), dry)
+
+    aggrdata_dir = Path(app.config['AGGRDATA_DIR'])
+    for model in models:
+        n_rows = len(np.load(aggrdata_dir / f'{model}.npy', mmap_mode='r'))
+        total = SegmentResolver.from_db(model.length).total
+        if n_rows != total:
+            logging.error(f'Aggregated {model} has {n_rows} rows, but there are {total} segments, run aggregate-all -f')
+            exit(1)
+
+    n_jobs = max(1, (os.cpu_count() or 1) // workers)  # threads for building each index
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(build_index, str(aggrdata_dir / f'{model}.npy'), str(model.index_file),
+                               str(model.delta_index_file), model.n_dimensions, app.config['ANNOY_DISTANCE'],
+                               n_trees, n_jobs, dry): model for model in models}
+        for future in as_completed(futures):
+            n_items, add_time, build_time = future.result()
+            logging.info(f'Indexed {futures[future]}: {n_items} items, {n_items / max(add_time, 1e-9):.0f} items/s, '
+                         f'build {build_time:.1f} s')
+
+
+def index_all_embeddings(n_trees=16, n_tracks=None, dry=False, force=False, incremental=False, workers=None):
     models = get_models()
-    for model in models.get_combinations():
-        index_embeddings(
-            model,
-            n_trees, n_tracks, dry, force
-        )
+    if incremental:
+        for model in models.get_combinations():
+            index_embeddings_incremental(model, n_trees, dry)
+    elif n_tracks is None:
+        index_all_embeddings_parallel(n_trees, dry, force, workers)
+    else:
+        for model in models.get_combinations():
+            index_embeddings(
+                model,
+                n_trees, n_tracks, dry, force
+            )
 
 
 # Entry points
@@ -87,6 +282,18 @@ def index_embeddings_command(input_dir, index_file, n_dimensions, segment_length
 @click.option('-n', '--n-tracks', type=int, help='only process limited amount of tracks')
 @click.option('-d', '--dry', is_flag=True, help='simulate the run')
 @click.option('-f', '--force', is_flag=True, help='overwrite annoy index and database entries if they exist')
+@click.option('-i', '--incremental', is_flag=True, help='only add new tracks to delta indexes')
+@click.option('-w', '--workers', type=int, help='number of indexes built in parallel (default: INDEX_WORKERS)')
+@with_appcontext
+def index_all_embeddings_command(n_trees, n_tracks, dry, force, incremental, workers):
+    """Build indexes of all models from the aggregated embeddings, or from embeddings files with -n or -i"""
+    index_all_embeddings(n_trees, n_tracks, dry, force, incremental, workers)
+
+
+@click.command('compact-indexes')
+@click.option('-t', '--n-trees', type=int, default=16, help='number of trees for the annoy index')
 @with_appcontext
-def index_all_embeddings_command(n_trees, n_tracks, dry, force):
-    index_all_embeddings(n_trees, n_tracks, dry, force)
+def compact_indexes_command(n_trees):
+    """Fold delta indexes that were created by index-all-embeddings --incremental into the base indexes"""
+    for model in get_models().get_combinations():
+        compact_index(model, n_trees)
@@ -1,69 +1,108 @@
-# import logging
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
+from sqlalchemy import or_
 from tqdm import tqdm
 
-from app.database.base import Track, db, needs_committing
-from app.database.metadata import Album, Artist, Tag, TrackMetadata
+from app.database.base import Track, db
+from app.database.membership import reset_membership_index
+from app.database.metadata import Album, Artist, Tag, TrackMetadata, track_metadata_tag_table
 
+Id3Tags = Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]  # title, artist, album, genre
 
-def load_id3_metadata(n_tracks=None):
+
+def read_id3(path: str) -> Optional[Id3Tags]:
+    """Runs in the pool process, returns None if the tags can't be read"""
     from tinytag import TinyTag
     from tinytag.tinytag import TinyTagException
 
-    audio_dir = Path(current_app.config['AUDIO_DIR'])
+    try:
+        metadata = TinyTag.get(path)
+    except TinyTagException:
+        return None
+    return metadata.title, metadata.artist, metadata.album, metadata.genre
+
+
+def _add_names(model, ids: Dict, rows: Dict, **filters):
+    """Inserts rows (name -> mapping) whose names are not in ids yet and puts their new ids into ids"""
+    rows = {name: row for name, row in rows.items() if name not in ids}
+    if not rows:
+        return
 
-    session_size = 0
-    for track in tqdm(Track.get_all(limit=n_tracks)):
-        path = audio_dir / track.path
-        try:
-            metadata = TinyTag.get(path)
-        except TinyTagException:
-            logging.error(f'Cannot read ID3 tags from {path}')
-
-        if TrackMetadata.get_by_id(track.id) is None:
-            track_name = metadata.title
-
-            artist_name = metadata.artist
-            # logging.debug(artist_name)
-            artist = Artist.get_by_name(artist_name)
-            if artist is None:
-                artist = Artist(name=artist_name)
-                db.session.add(artist)
-
-            album_name = metadata.album
-            # logging.debug(album_name)
-            album = Album.get_by_name(album_name)
-            if album is None:
-                album = Album(name=album_name, artist=artist)
-                db.session.add(album)
-
-            track_metadata = TrackMetadata(track=track, name=track_name, album=album, artist=artist)
-            db.session.add(track_metadata)
-
-            genre = metadata.genre
-            # logging.debug(genre)
-            if genre:
-                tag = Tag.get_by_name_and_group(genre, 'genre')
-                if tag is None:
-                    tag = Tag(name=genre, group='genre')
-                    db.session.add(tag)
-                tag.tracks_metadata.append(track_metadata)
-
-            session_size += 1
-            if needs_committing(session_size):
-                db.session.commit()
-                session_size = 0
+    db.session.bulk_insert_mappings(model, list(rows.values()))
+    names = [name for name in rows if name is not None]
+    condition = or_(model.name.in_(names), model.name.is_(None)) if None in rows else model.name.in_(names)
+    ids.update(db.session.query(model.name, model.id).filter(condition).filter_by(**filters))
 
+
+def _write_batch(batch: List[Tuple[int, Id3Tags]], artist_ids: Dict, album_ids: Dict, genre_ids: Dict):
+    """Resolves the names against the in-memory maps, adding the new ones, and inserts metadata of the tracks"""
+    _add_names(Artist, artist_ids, {artist: {'name': artist} for _, (_, artist, _, _) in batch})
+    _add_names(Album, album_ids, {album: {'name': album, 'artist_id': artist_ids[artist]}
+                                  for _, (_, artist, album, _) in reversed(batch)})  # first artist of the album wins
+    _add_names(Tag, genre_ids, {genre: {'name': genre, 'group': 'genre'} for _, (_, _, _, genre) in batch if genre},
+               group='genre')
+
+    db.session.bulk_insert_mappings(TrackMetadata, [
+        {'id': track_id, 'name': title, 'artist_id': artist_ids[artist], 'album_id': album_ids[album]}
+        for track_id, (title, artist, album, _) in batch
+    ])
+    track_tags = [{'track_id': track_id, 'tag_id': genre_ids[genre]} for track_id, (_, _, _, genre) in batch if genre]
+    if track_tags:
+        db.session.execute(track_metadata_tag_table.insert(), track_tags)
     db.session.commit()
 
 
+def load_id3_metadata(n_tracks=None, workers=None):
+    """
+    Parses ID3 tags of the tracks without metadata in a pool of processes, the results are streamed in order to the
+    main process, which resolves artist, album and genre names against in-memory maps and inserts the rows in bulk
+    """
+    audio_dir = Path(current_app.config['AUDIO_DIR'])
+    batch_size = current_app.config['DB_COMMIT_BATCH_SIZE']
+    workers = workers or current_app.config['ID3_WORKERS']
+
+    tracks = Track.query_all().with_entities(Track.id, Track.path) \
+        .filter(Track.id.notin_(db.session.query(TrackMetadata.id)))
+    if n_tracks is not None:
+        tracks = tracks.limit(n_tracks)
+    tracks = tracks.all()
+    logging.info(f'Reading ID3 tags of {len(tracks)} tracks without metadata')
+
+    artist_ids = Artist.get_ids_by_name()
+    album_ids = Album.get_ids_by_name()
+    genre_ids = {name: _id for (name, group), _id in Tag.get_ids_by_name_and_group().items() if group == 'genre'}
+
+    paths = [str(audio_dir / path) for _, path in tracks]
+    batch = []
+    try:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = pool.map(read_id3, paths, chunksize=max(1, min(64, len(paths) // (workers * 4))))
+            for (track_id, _), path, tags in zip(tracks, paths, tqdm(results, total=len(tracks))):
+                if tags is None:
+                    logging.error(f'Cannot read ID3 tags from {path}')
+                    continue
+
+                batch.append((track_id, tags))
+                if len(batch) >= batch_size:
+                    _write_batch(batch, artist_ids, album_ids, genre_ids)
+                    batch = []
+
+        if batch:
+            _write_batch(batch, artist_ids, album_ids, genre_ids)
+    finally:
+        reset_membership_index()  # batches that were written are shown even if the run was interrupted
+
+
 @click.command('load-id3-metadata')
 @click.option('-n', '--n-tracks', type=int)
+@click.option('-w', '--workers', type=int, help='number of processes that parse the tags (default: ID3_WORKERS)')
 @with_appcontext
-def load_id3_metadata_command(n_tracks):
-    load_id3_metadata(n_tracks)
+def load_id3_metadata_command(n_tracks, workers):
+    load_id3_metadata(n_tracks, workers)
@@ -1,4 +1,10 @@
 import csv
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Optional
 
 import click
 import requests
@@ -8,8 +14,9 @@ from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from tqdm import tqdm
 
-from app.database.base import Track, db, needs_committing
-from app.database.metadata import Album, Artist, Tag, TrackMetadata
+from app.database.base import Track, bulk_insert, db
+from app.database.membership import reset_membership_index
+from app.database.metadata import Album, Artist, Tag, TrackMetadata, track_metadata_tag_table
 
 TAG_HYPHEN = '---'
 
@@ -19,122 +26,189 @@ def parse_id(value):
 
 
 def load_jamendo_metadata(input_file):
-    total_rows = sum(1 for _ in open(input_file)) - 1
-
+    """
+    Loads metadata of the tracks in the collection from MTG-Jamendo TSV file. Existing ids are loaded into memory
+    first, so new artists, albums, tags and their associations are collected without any queries per row and written
+    with bulk inserts. Metadata of each track is committed together with its tags, tracks that already have metadata
+    are skipped
+    """
+    track_ids = dict(db.session.query(Track.path, Track.id))
+    metadata_ids = {_id for _id, in db.session.query(TrackMetadata.id)}
+    artist_ids = {_id for _id, in db.session.query(Artist.id)}
+    album_ids = {_id for _id, in db.session.query(Album.id)}
+    tag_ids = Tag.get_ids_by_name_and_group()
+
+    artists, albums, tags, tracks_metadata = [], [], [], []
+    track_tags = {}
     with open(input_file) as fp:
         reader = csv.reader(fp, delimiter='\t')
         next(reader, None)  # skip header
 
-        session_size = 0
-        for row in tqdm(reader, total=total_rows):  # TODO: investigate why performance slows down
-            track_jamendo_id = parse_id(row[0])
-            artist_id = parse_id(row[1])
-            album_id = parse_id(row[2])
-            path = row[3]
-            raw_tags = row[5:]
-
-            track = db.session.query(Track).filter(Track.path == path).first()
-            if track is not None:
-                if TrackMetadata.get_by_id(track.id) is None:
-                    artist = Artist.get_by_id(artist_id)
-                    if artist is None:
-                        artist = Artist(id=artist_id)
-                        db.session.add(artist)
-
-                    album = Album.get_by_id(album_id)
-                    if album is None:
-                        album = Album(id=album_id, artist=artist)
-                        db.session.add(artist)
-
-                    track_metadata = TrackMetadata(track=track, streaming_id=str(track_jamendo_id),
-                                                   album=album, artist=artist)
-                    db.session.add(track_metadata)
-
-                    for raw_tag in raw_tags:
-                        # split genre---rock into group=genre and name=rock
-                        tag_group, tag_name = raw_tag.split(TAG_HYPHEN)
-                        tag = Tag.get_by_name_and_group(tag_name, tag_group)
-                        if tag is None:
-                            tag = Tag(name=tag_name, group=tag_group)
-                            db.session.add(tag)
-
-                        tag.tracks_metadata.append(track_metadata)
-
-                    session_size += 1
-                    if needs_committing(session_size):
-                        db.session.commit()
-                        session_size = 0
-
-    db.session.commit()
+        for row in tqdm(reader, desc='Reading'):
+            track_id = track_ids.get(row[3])
+            if track_id is None or track_id in metadata_ids:
+                continue
+            metadata_ids.add(track_id)
 
+            artist_id = parse_id(row[1])
+            if artist_id not in artist_ids:
+                artist_ids.add(artist_id)
+                artists.append({'id': artist_id})
 
-def get_http_session():
+            album_id = parse_id(row[2])
+            if album_id not in album_ids:
+                album_ids.add(album_id)
+                albums.append({'id': album_id, 'artist_id': artist_id})
+
+            tracks_metadata.append({'id': track_id, 'streaming_id': str(parse_id(row[0])), 'artist_id': artist_id,
+                                    'album_id': album_id})
+
+            for raw_tag in row[5:]:
+                # split genre---rock into group=genre and name=rock
+                tag_group, tag_name = raw_tag.split(TAG_HYPHEN)
+                if (tag_name, tag_group) not in tag_ids:
+                    tag_ids[(tag_name, tag_group)] = None  # id is assigned by the database
+                    tags.append({'name': tag_name, 'group': tag_group})
+                track_tags.setdefault(track_id, []).append((tag_name, tag_group))
+
+    logging.info(f'Adding {len(artists)} artists, {len(albums)} albums, {len(tags)} tags and metadata of '
+                 f'{len(tracks_metadata)} tracks')
+    bulk_insert(Artist, artists)
+    bulk_insert(Album, albums)
+    bulk_insert(Tag, tags)
+    tag_ids = Tag.get_ids_by_name_and_group()
+
+    batch_size = current_app.config['DB_COMMIT_BATCH_SIZE']
+    for pos in tqdm(range(0, len(tracks_metadata), batch_size), desc='Writing'):
+        batch = tracks_metadata[pos:pos + batch_size]
+        db.session.bulk_insert_mappings(TrackMetadata, batch)
+        batch_tags = [{'track_id': track['id'], 'tag_id': tag_ids[tag]}
+                      for track in batch for tag in track_tags.get(track['id'], [])]
+        if batch_tags:
+            db.session.execute(track_metadata_tag_table.insert(), batch_tags)
+        db.session.commit()
+    reset_membership_index()
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter: allows rate requests per second on average, with bursts of up to
+    capacity requests"""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def get_http_session(pool_size=10):
+    # failed requests are retried with exponential backoff, Retry-After of 429 responses is respected
     retry_strategy = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_size)
     http_session = requests.Session()
     http_session.mount("https://", adapter)
     http_session.mount("http://", adapter)
     return http_session
 
 
-def query_jamendo_metadata(db_model, jamendo_entity, batch_size, http_session=None):
+def fetch_jamendo_results(http_session, rate_limiter: TokenBucket, url: str, client_id: str, ids: list,
+                          batch_size: int) -> list:
+    """Runs in the pool thread, returns results of one API call"""
+    params = {
+        'client_id': client_id,
+        'id[]': ids,
+        'limit': batch_size
+    }
+
+    rate_limiter.acquire()
+    response = http_session.get(url, params=params)
+    if response.status_code != 200:
+        response.raise_for_status()
+
+    response_json = response.json()
+    if response_json['headers']['code'] != 0:
+        raise RuntimeError(response_json['headers']['error_message'])
+    return response_json['results']
+
+
+def query_jamendo_metadata(db_model, jamendo_entity, batch_size, http_session=None, workers=None,
+                           rate_limiter=None):
+    """
+    Fills names of the rows that don't have them yet, API calls run in a pool of threads with at most workers
+    requests in flight and the rate limited by rate_limiter. Results are written as they arrive, so an interrupted
+    run continues with the remaining rows
+    """
+    config = current_app.config
+    workers = workers or config['JAMENDO_WORKERS']
     if http_session is None:
-        http_session = get_http_session()
+        http_session = get_http_session(workers)
+    if rate_limiter is None:
+        rate_limiter = TokenBucket(config['JAMENDO_RATE_LIMIT'])
 
-    url = f'https://api.jamendo.com/v3.0/{jamendo_entity}/'
+    url = f'{config["JAMENDO_API_URL"]}/{jamendo_entity}/'
+    id_column = db_model.streaming_id if db_model == TrackMetadata else db_model.id
     # we need '==' instead of 'is' for None comparison in sqlalchemy
-    noname_rows = db.session.query(db_model).filter(db_model.name == None).all()  # noqa: E711
-    for rows in tqdm([noname_rows[pos:pos + batch_size] for pos in range(0, len(noname_rows), batch_size)],
-                     desc=jamendo_entity):
-
-        if db_model == TrackMetadata:
-            id_mapping = {row.streaming_id: row.id for row in rows}
-
-            def map_id(_id):
-                return id_mapping[_id]
-            ids = set(id_mapping.keys())
-        else:
-            def map_id(_id):
-                return _id
-            ids = {row.id for row in rows}
-
-        params = {
-            'client_id': current_app.config['JAMENDO_CLIENT_ID'],
-            'id[]': list(ids),
-            'limit': batch_size
-        }
-
-        response = http_session.get(url, params=params)
-        if response.status_code != 200:
-            response.raise_for_status()
-
-        response_json = response.json()
-        if response_json['headers']['code'] != 0:
-            raise RuntimeError(response_json['headers']['error_message'])
-
-        mappings = []
-        for result in response_json['results']:
-            mappings.append({
-                'id': map_id(result['id']),
-                'name': result['name']
-            })
-            ids.remove(result['id'])
-
-        for missed_id in ids:
-            mappings.append({
-                'id': map_id(missed_id),
-                'name': f'Deleted ({missed_id})'
-            })
-
-        db.session.bulk_update_mappings(db_model, mappings)
-        db.session.commit()
-
-
-def query_all_jamendo_metadata(batch_size):
-    http_session = get_http_session()
-    query_jamendo_metadata(Artist, 'artists', batch_size, http_session)
-    query_jamendo_metadata(Album, 'albums', batch_size, http_session)
-    query_jamendo_metadata(TrackMetadata, 'tracks', batch_size, http_session)
+    noname_rows = db.session.query(id_column, db_model.id).filter(db_model.name == None).all()  # noqa: E711
+    id_mapping = {str(jamendo_id): _id for jamendo_id, _id in noname_rows}  # API returns ids as strings
+    jamendo_ids = list(id_mapping.keys())
+    batches = [jamendo_ids[pos:pos + batch_size] for pos in range(0, len(jamendo_ids), batch_size)]
+
+    def fetch(ids):
+        return fetch_jamendo_results(http_session, rate_limiter, url, config['JAMENDO_CLIENT_ID'], ids, batch_size)
+
+    try:
+        with ThreadPoolExecutor(workers) as pool, tqdm(total=len(batches), desc=jamendo_entity) as progress:
+            batches = iter(batches)
+            pending = {pool.submit(fetch, ids): ids for ids in islice(batches, workers)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ids = set(pending.pop(future))
+                    mappings = []
+                    for result in future.result():
+                        mappings.append({
+                            'id': id_mapping[str(result['id'])],
+                            'name': result['name']
+                        })
+                        ids.discard(str(result['id']))
+
+                    for missed_id in ids:
+                        mappings.append({
+                            'id': id_mapping[missed_id],
+                            'name': f'Deleted ({missed_id})'
+                        })
+
+                    db.session.bulk_update_mappings(db_model, mappings)
+                    db.session.commit()
+                    progress.update()
+
+                    for next_ids in islice(batches, 1):
+                        pending[pool.submit(fetch, next_ids)] = next_ids
+    finally:
+        reset_membership_index()  # names that were written are shown even if the run was interrupted
+
+
+def query_all_jamendo_metadata(batch_size, workers=None, rate_limit=None):
+    workers = workers or current_app.config['JAMENDO_WORKERS']
+    http_session = get_http_session(workers)
+    # one limiter for all entities, as the API limits the client
+    rate_limiter = TokenBucket(rate_limit or current_app.config['JAMENDO_RATE_LIMIT'])
+    query_jamendo_metadata(Artist, 'artists', batch_size, http_session, workers, rate_limiter)
+    query_jamendo_metadata(Album, 'albums', batch_size, http_session, workers, rate_limiter)
+    query_jamendo_metadata(TrackMetadata, 'tracks', batch_size, http_session, workers, rate_limiter)
 
 
 @click.command('load-jamendo-metadata')
@@ -146,8 +220,10 @@ def load_jamendo_metadata_command(input_file):
 
 @click.command('query-jamendo-metadata')
 @click.option('-b', '--batch-size', type=int, default=None)
+@click.option('-w', '--workers', type=int, help='max number of requests in flight (default: JAMENDO_WORKERS)')
+@click.option('-r', '--rate-limit', type=float, help='max number of requests per second (default: JAMENDO_RATE_LIMIT)')
 @with_appcontext
-def query_jamendo_metadata_command(batch_size):
+def query_jamendo_metadata_command(batch_size, workers, rate_limit):
     if batch_size is None:
         batch_size = current_app.config['JAMENDO_BATCH_SIZE']
-    query_all_jamendo_metadata(batch_size)
+    query_all_jamendo_metadata(batch_size, workers, rate_limit)
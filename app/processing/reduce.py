@@ -1,17 +1,29 @@
 import logging
+import os
+import pickle
+import tempfile
 from pathlib import Path
-from typing import Iterable, List
+from typing import Dict, Iterable, List, Optional
 
 import click
 import numpy as np
 from flask import current_app
 from flask.cli import with_appcontext
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import TSNE
+from sklearn.preprocessing import StandardScaler
 from tqdm import tqdm
 
-from app.database.base import Track
-from app.models import get_models
+from app.aggrdata import aggrdata
+from app.database.base import Track, db
+from app.database.manifest import Extraction, Manifest
+from app.models import Model, get_models
+from app.prefetch import prefetch
+from app.processing.transform import (get_aggregated_file, get_aggregation_order, set_aggregated_fingerprint,
+                                      update_aggregated)
+
+TSNE_PARAMS = {'n_components': 2, 'random_state': 0}
+UMAP_PARAMS = {'n_components': 2, 'init': 'random', 'random_state': 0}
 
 
 def reduce_generic(embeddings: List[np.ndarray], projection, n_input_dimensions=None, preprocess=None):
@@ -31,20 +43,28 @@ def reduce_generic(embeddings: List[np.ndarray], projection, n_input_dimensions=
     return np.split(embeddings_reduced, np.cumsum(lengths)[:-1])
 
 
+def transform_generic(embeddings: List[np.ndarray], transformer):
+    """Same as reduce_generic, but places embeddings into already fitted projection"""
+    embeddings_stacked = np.vstack(embeddings)
+    lengths = list(map(len, embeddings))
+    embeddings_reduced = np.asarray(transformer.transform(embeddings_stacked))
+    return np.split(embeddings_reduced, np.cumsum(lengths)[:-1])
+
+
 def reduce_pca(embeddings: Iterable[np.ndarray]):
     projection = PCA(random_state=0, copy=False)
     return reduce_generic(list(embeddings), projection)
 
 
-def reduce_tsne(embeddings: Iterable[np.ndarray]):
-    projection = TSNE(n_components=2, random_state=0, verbose=True)
+def reduce_tsne(embeddings: Iterable[np.ndarray], verbose=1):
+    projection = TSNE(**TSNE_PARAMS, verbose=verbose)
     # TODO: add n_input_dimension, as we don't need all pca as input to tsne
     return reduce_generic(list(embeddings), projection)
 
 
-def reduce_umap(embeddings: Iterable[np.ndarray]):
+def reduce_umap(embeddings: Iterable[np.ndarray], verbose=False):
     from umap import UMAP
-    projection = UMAP(n_components=2, init='random', random_state=0)
+    projection = UMAP(**UMAP_PARAMS, verbose=verbose)
     return reduce_generic(list(embeddings), projection)
 
 
@@ -56,7 +76,7 @@ def standardize(embeddings_stacked):
     return result
 
 
-def reduce_std_pca(embeddings: Iterable[np.ndarray], batch_size=None):
+def reduce_std_pca(embeddings: Iterable[np.ndarray]):
     projection = PCA(random_state=0, copy=False)
     return reduce_generic(list(embeddings), projection, preprocess=standardize)
 
@@ -69,13 +89,121 @@ REDUCE = {
 }
 
 
-def reduce(input_dir, output_dir, projection: str, n_tracks=None, dry=False, force=False):
+def _get_batches(n_rows: int, batch_size: int, min_size: int) -> List[slice]:
+    """Last batch is merged into the previous one if it is smaller than min_size"""
+    starts = list(range(0, n_rows, batch_size))
+    if len(starts) > 1 and n_rows - starts[-1] < min_size:
+        starts.pop()
+    return [slice(start, stop) for start, stop in zip(starts, starts[1:] + [n_rows])]
+
+
+def _preprocess_batch(batch: np.ndarray, scaler: Optional[StandardScaler]) -> np.ndarray:
+    batch = np.array(batch, dtype=np.float64)  # copy, as the batch is modified in place
+    return scaler.transform(batch) if scaler is not None else batch
+
+
+def reduce_pca_streaming(embeddings: np.ndarray, output: Optional[np.ndarray], batch_size: int, standardize=False):
+    """
+    Out-of-core version of reduce_pca and reduce_std_pca for memory-mapped embeddings: mean and variance for the
+    standardization are computed in one pass over batches of rows, PCA is fitted incrementally in another one and the
+    third writes projected rows into output (skipped if it is None)
+    """
+    n_components = min(embeddings.shape)  # same as PCA
+    # each partial fit needs at least as many rows as there are components
+    batches = _get_batches(len(embeddings), max(batch_size, n_components), n_components)
+
+    scaler = None
+    if standardize:
+        scaler = StandardScaler(copy=False)
+        for batch in tqdm(batches, desc='Standardizing'):
+            scaler.partial_fit(np.asarray(embeddings[batch], dtype=np.float64))
+
+    projection = IncrementalPCA(n_components=n_components, copy=False)
+    for batch in tqdm(batches, desc='Fitting'):
+        projection.partial_fit(_preprocess_batch(embeddings[batch], scaler))
+
+    if output is not None:
+        for batch in tqdm(batches, desc='Projecting'):
+            output[batch] = projection.transform(_preprocess_batch(embeddings[batch], scaler))
+
+
+STREAMING = {
+    'pca': False,
+    'std-pca': True
+}  # whether embeddings are standardized
+
+
+def fit_tsne(embeddings_stacked: np.ndarray, verbose=False):
+    """Requires openTSNE, unlike sklearn it can place new points into the fitted embedding"""
+    from openTSNE import TSNE as OpenTSNE
+    return OpenTSNE(**TSNE_PARAMS, verbose=verbose).fit(embeddings_stacked)
+
+
+def fit_umap(embeddings_stacked: np.ndarray, verbose=False):
+    from umap import UMAP
+    return UMAP(**UMAP_PARAMS, verbose=verbose).fit(embeddings_stacked)
+
+
+FIT = {
+    'tsne': fit_tsne,
+    'umap': fit_umap
+}
+
+_transformers = {}
+
+
+def get_transformer_file(model: Model) -> Path:
+    return Path(current_app.config['PROJECTION_MODELS_DIR']) / f'{model}.pkl'
+
+
+def get_transformer(model: Model):
+    """Returns fitted projection for the model or None if it wasn't fitted with fit-projections. It is loaded once per
+    process and reloaded when the file is replaced"""
+    path = get_transformer_file(model)
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    entry = _transformers.get(str(model))
+    if entry is None or entry[0] != mtime:
+        logging.info(f'Loading {path}')
+        with path.open('rb') as fp:
+            entry = mtime, pickle.load(fp)
+        _transformers[str(model)] = entry
+    return entry[1]
+
+
+def fit_projection(model: Model, sample_size: int, dry=False):
+    """Fits transformable projection on a random sample of segments from the aggregated PCA embeddings of the model,
+    the same input as for projections that are computed dynamically"""
+    embeddings = aggrdata.get(str(model.with_projection('pca')))
+    rng = np.random.default_rng(0)
+    indices = np.sort(rng.choice(len(embeddings), min(sample_size, len(embeddings)), replace=False))
+    sample = np.asarray(embeddings[indices, :current_app.config['PCA_DIMS']], dtype=np.float32)
+
+    logging.info(f'Fitting {model.projection} on {len(sample)} segments...')
+    transformer = FIT[model.projection](sample, verbose=True)
+
+    if not dry:
+        output_file = get_transformer_file(model)
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=output_file.parent, suffix='.tmp', delete=False) as fp:
+            pickle.dump(transformer, fp)
+        os.replace(fp.name, output_file)
+        logging.info(f'Saved {output_file}')
+
+
+def reduce(input_dir, output_dir, projection: str, n_tracks=None, dry=False, force=False) -> Dict[int, int]:
+    """Returns number of reduced embeddings for each track id"""
     try:
         reduce_func = REDUCE[projection]
     except KeyError:
         raise ValueError(f'Invalid projection_type: {projection}')
 
-    embeddings = [track.get_embeddings_from_file(input_dir) for track in tqdm(Track.get_all(limit=n_tracks))]
+    tracks = Track.get_all(limit=n_tracks)
+    embeddings = list(tqdm(prefetch(Path(input_dir) / track.get_embeddings_filename() for track in tracks),
+                           total=len(tracks)))
 
     logging.info(f'Applying {projection}...')
     embeddings_reduced = reduce_func(embeddings)
@@ -83,19 +211,103 @@ def reduce(input_dir, output_dir, projection: str, n_tracks=None, dry=False, for
     logging.info('Saving reduced...')
     if not dry:
         output_dir = Path(output_dir)
-        for track, data in zip(tqdm(Track.get_all(limit=n_tracks)), embeddings_reduced):
+        for track, data in zip(tqdm(tracks), embeddings_reduced):
             output_file = output_dir / track.get_embeddings_filename()
             if force or not output_file.exists():
                 output_file.parent.mkdir(parents=True, exist_ok=True)
                 np.save(output_file, data)
 
     logging.info('Done!')
+    return {track.id: len(data) for track, data in zip(tracks, embeddings_reduced)}
+
+
+def _reduce_in_batches(model: Model, input_model: Model, lengths: List[int], batch_size: int,
+                       output_file: Optional[Path]):
+    """Reduces the aggregated embeddings of the input model with reduce_pca_streaming, so that the collection doesn't
+    have to fit into memory. The input is aggregated first if needed, unless it is a dry run (output_file is None)"""
+    input_file = get_aggregated_file(input_model)
+    if output_file is not None:
+        update_aggregated(input_model)
+    elif not input_file.exists():
+        logging.error(f'{input_model} is not aggregated, run aggregate-all or reduce-all without -d')
+        exit(1)
+    embeddings = np.load(str(input_file), mmap_mode='r')
+    if sum(lengths) != len(embeddings):
+        logging.error(f'Aggregated {input_model} has {len(embeddings)} rows, but its track files have {sum(lengths)}, '
+                      f'run aggregate-all -f')
+        exit(1)
+
+    logging.info(f'Applying {model.projection} in batches of {batch_size}...')
+    if output_file is None:
+        reduce_pca_streaming(embeddings, None, batch_size, STREAMING[model.projection])
+        return None
+
+    reduced = np.lib.format.open_memmap(str(output_file), mode='w+', dtype=np.float16,
+                                        shape=(len(embeddings), min(embeddings.shape)))
+    reduce_pca_streaming(embeddings, reduced, batch_size, STREAMING[model.projection])
+    return reduced
+
+
+def _reduce_in_memory(model: Model, input_model: Model, tracks: List[Track], lengths: List[int],
+                      output_file: Optional[Path]):
+    embeddings = list(tqdm(input_model.iter_embeddings_from_file(tracks), total=len(tracks)))
+    logging.info(f'Applying {model.projection}...')
+    embeddings_reduced = REDUCE[model.projection](embeddings)
+    if output_file is None:
+        return None
+
+    n_dimensions = embeddings_reduced[0].shape[1] if embeddings_reduced else 0
+    reduced = np.lib.format.open_memmap(str(output_file), mode='w+', dtype=np.float16,
+                                        shape=(sum(lengths), n_dimensions))
+    offset = 0
+    for data in embeddings_reduced:
+        reduced[offset:offset + len(data)] = data
+        offset += len(data)
+    return reduced
+
+
+def reduce_aggregated(model: Model, n_tracks=None, dry=False, batch_size=None, track_files=True) -> Dict[int, int]:
+    """
+    Reduces embeddings of the input model and writes the result directly to the aggregated file of the model, with
+    tracks in the same order as aggregate puts them. Track files are split from it unless track_files is False, in which
+    case the existing track files are removed, since they don't match the new projection anymore. With batch_size, pca
+    and std-pca are computed out-of-core from the aggregated input. Returns number of reduced embeddings for each
+    track id
+    """
+    input_model = model.without_projection()
+    tracks, lengths, _ = get_aggregation_order(input_model, n_tracks)
+
+    output_file = get_aggregated_file(model)
+    tmp_file = output_file.with_name(f'{output_file.name}.tmp') if not dry else None
+    if not dry:
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+    if batch_size is not None and model.projection in STREAMING and n_tracks is None:
+        reduced = _reduce_in_batches(model, input_model, lengths, batch_size, tmp_file)
+    else:
+        reduced = _reduce_in_memory(model, input_model, tracks, lengths, tmp_file)
+
+    if not dry:
+        reduced.flush()
+        # the projection is fitted on all tracks, so every track file changes together with the aggregated file
+        logging.info('Saving reduced...' if track_files else 'Removing outdated track files...')
+        offset = 0
+        for track, length in zip(tqdm(tracks), lengths):
+            track_file = model.data_dir / track.get_embeddings_filename()
+            if track_files:
+                track_file.parent.mkdir(parents=True, exist_ok=True)
+                np.save(track_file, reduced[offset:offset + length])
+            elif track_file.exists():
+                track_file.unlink()
+            offset += length
+
+        del reduced
+        os.replace(tmp_file, output_file)
 
+    logging.info('Done!')
+    return dict(zip([track.id for track in tracks], lengths))
 
-def reduce_all(projection=None, n_tracks=None, dry=False, force=False):
-    app = current_app
-    data_dir = Path(app.config['DATA_DIR'])
 
+def reduce_all(projection=None, n_tracks=None, dry=False, force=False, batch_size=None, track_files=True):
     models = get_models()
     if projection is not None:
         projection_models = models.get_offline_projections(projection)
@@ -103,13 +315,42 @@ def reduce_all(projection=None, n_tracks=None, dry=False, force=False):
         projection_models = models.get_all_offline_projections()
 
     for model in projection_models:
+        input_name = str(model.without_projection())
+        manifest = Manifest([input_name, str(model)])
+        if not force and manifest.is_derived_current(str(model), input_name):
+            logging.info(f'{model} is up to date with {input_name}, skipping')
+            continue
+
+        inputs = manifest.get_rows(input_name, Extraction.DONE)
         logging.info(f'Generating {model}')
-        reduce(
-            data_dir / str(model.without_projection()),
-            data_dir / str(model),
-            model.projection,
-            n_tracks, dry, force
-        )
+        lengths = reduce_aggregated(model, n_tracks, dry, batch_size, track_files)
+
+        if not dry and n_tracks is None:
+            fingerprint = manifest.fingerprint(input_name)
+            for row in inputs:
+                if row.id in lengths:
+                    manifest.record(row.id, str(model), row.audio_signature, fingerprint, lengths[row.id])
+            db.session.commit()
+
+        # the aggregated file is already up to date, so that aggregate-all skips it
+        if not dry:
+            set_aggregated_fingerprint(model, manifest.fingerprint(str(model)) if n_tracks is None else None)
+
+
+def fit_projections(projection, sample_size=None, dry=False):
+    sample_size = sample_size or current_app.config['PROJECTION_FIT_SAMPLE']
+    projections = [projection] if projection is not None else list(FIT.keys())
+
+    for projection in projections:
+        for model in get_models().get_offline_projections(projection):
+            logging.info(f'Fitting {model}')
+            try:
+                fit_projection(model, sample_size, dry)
+            except ImportError as e:
+                if len(projections) == 1:
+                    raise
+                logging.warning(f'Skipping {projection}: {e}')
+                break
 
 
 # Entry points
@@ -131,6 +372,21 @@ def reduce_command(input_dir, output_dir, projection: str, n_tracks, dry, force)
 @click.option('-n', '--n-tracks', type=int, help='only process limited amount of tracks')
 @click.option('-d', '--dry', is_flag=True, help='simulate the run')
 @click.option('-f', '--force', is_flag=True, help='force overwriting of embedding files')
+@click.option('-b', '--batch-size', type=int,
+              help='reduce pca and std-pca out-of-core in batches of that many segments of the aggregated embeddings')
+@click.option('--no-track-files', is_flag=True,
+              help='write only the aggregated projections, delete their per-track files (only experiments read them)')
+@with_appcontext
+def reduce_all_command(projection, n_tracks, dry, force, batch_size, no_track_files):
+    """Computes offline projections of all models and writes them directly to the aggregated files"""
+    reduce_all(projection, n_tracks, dry, force, batch_size, not no_track_files)
+
+
+@click.command('fit-projections')
+@click.option('--projection', type=click.Choice(FIT.keys(), case_sensitive=False))
+@click.option('-n', '--sample-size', type=int, help='number of segments to fit on (default: PROJECTION_FIT_SAMPLE)')
+@click.option('-d', '--dry', is_flag=True, help='simulate the run')
 @with_appcontext
-def reduce_all_command(projection, n_tracks, dry, force):
-    reduce_all(projection, n_tracks, dry, force)
+def fit_projections_command(projection, sample_size, dry):
+    """Fits t-SNE (requires openTSNE) and UMAP per model, so plots only need to transform the tracks"""
+    fit_projections(projection, sample_size, dry)
@@ -1,5 +1,7 @@
+import logging
+import os
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import click
 import numpy as np
@@ -7,16 +9,70 @@ from flask import current_app
 from flask.cli import with_appcontext
 from tqdm import tqdm
 
-from app.database.base import Track
+from app.database.base import SegmentResolver, Track
+from app.database.manifest import Manifest
 from app.models import Model, get_models
+from app.prefetch import prefetch, read_shape
+
+
+def _read_shapes(model: Model, tracks: List[Track]) -> List[Tuple[int, ...]]:
+    data_dir = model.data_dir
+    shapes = prefetch((data_dir / track.get_embeddings_filename() for track in tracks), load=read_shape)
+    return list(tqdm(shapes, desc=f'{model} shapes', total=len(tracks)))
+
+
+def _check_ranges(resolver: SegmentResolver, tracks: List[Track], lengths: List[int]):
+    """Rows of each track in the aggregated file have to be the segment ids of its segmentation, if it has one"""
+    ranges = dict(zip(resolver.track_ids.tolist(), zip(resolver.start_ids.tolist(), resolver.stop_ids.tolist())))
+    offset = 0
+    for track, length in zip(tracks, lengths):
+        expected = ranges.get(track.id)
+        if expected is not None and expected != (offset, offset + length):
+            logging.error(f'Rows {offset}:{offset + length} of {track} don\'t match its segments '
+                          f'{expected[0]}:{expected[1]}, its embeddings changed after it was segmented, so extract '
+                          f'it again with extract-all -f to segment it anew')
+            exit(1)
+        offset += length
+
+
+def get_aggregation_order(model: Model, n_tracks: Optional[int] = None) -> Tuple[List[Track], List[int], int]:
+    """Returns tracks in the order of the rows of the aggregated file, their number of rows and the number of
+    dimensions, which are read from the headers of the track files"""
+    # rows of the aggregated file are segment ids, incrementally indexed tracks have ids after all the others
+    resolver = SegmentResolver.from_db(model.length)
+    tracks = resolver.sort_tracks(Track.get_all(limit=n_tracks))
+
+    shapes = _read_shapes(model, tracks)
+    if any(len(shape) != 2 or shape[1] != shapes[0][1] for shape in shapes):
+        logging.error(f'Irregular embeddings of {model}!')
+        exit(1)
+    lengths = [shape[0] for shape in shapes]
+    _check_ranges(resolver, tracks, lengths)
+    return tracks, lengths, shapes[0][1] if shapes else model.n_dimensions
+
+
+def get_aggregated_file(model: Model) -> Path:
+    return Path(current_app.config['AGGRDATA_DIR']) / f'{model}.npy'
 
 
 def aggregate(model: Model, output_file: Path, n_tracks: Optional[int] = None):
-    tracks = tqdm(Track.get_all(limit=n_tracks), desc=str(model))
-    embeddings = model.get_embeddings_from_file(tracks)
-    embeddings = np.vstack(embeddings)
-    embeddings = embeddings.astype(np.float16)
-    np.save(output_file, embeddings)
+    """
+    Writes embeddings of all tracks into one file in two passes, so the collection is never loaded into memory: the
+    first pass sizes the output from the headers of the track files, the second fills memory-mapped temporary file,
+    which replaces the output file once it's complete
+    """
+    tracks, lengths, n_dimensions = get_aggregation_order(model, n_tracks)
+    tmp_file = output_file.with_name(f'{output_file.name}.tmp')
+    aggregated = np.lib.format.open_memmap(str(tmp_file), mode='w+', dtype=np.float16,
+                                           shape=(sum(lengths), n_dimensions))
+    offset = 0
+    embeddings = model.iter_embeddings_from_file(tracks)
+    for track_embeddings, length in zip(tqdm(embeddings, desc=str(model), total=len(tracks)), lengths):
+        aggregated[offset:offset + length] = track_embeddings
+        offset += length
+    aggregated.flush()
+    del aggregated
+    os.replace(tmp_file, output_file)
 
 
 @click.command('embeddings-to-float16')
@@ -40,13 +96,43 @@ def aggregate_command(dataset, architecture, layer, output_file, projection, n_t
     aggregate(model, Path(output_file), n_tracks)
 
 
+def set_aggregated_fingerprint(model: Model, fingerprint: Optional[str]):
+    """Stores fingerprint of the manifest the aggregated file was made from, None if it doesn't correspond to it"""
+    fingerprint_file = get_aggregated_file(model).with_suffix('.manifest')
+    if fingerprint is not None:
+        fingerprint_file.write_text(fingerprint)
+    elif fingerprint_file.exists():
+        fingerprint_file.unlink()
+
+
+def update_aggregated(model: Model, n_tracks: Optional[int] = None, force=False):
+    """Aggregates the model, unless the manifest didn't change since it was aggregated"""
+    output_file = get_aggregated_file(model)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    fingerprint_file = output_file.with_suffix('.manifest')
+    manifest = Manifest([str(model)])
+    fingerprint = manifest.fingerprint(str(model)) if manifest.rows and n_tracks is None else None
+
+    if not force and fingerprint is not None and output_file.exists() and fingerprint_file.exists() \
+            and fingerprint_file.read_text() == fingerprint:
+        logging.info(f'{model} is up to date, skipping')
+        return
+    if model.projection is not None and output_file.exists() and not model.data_dir.exists():
+        logging.info(f'{model} was written by reduce-all --no-track-files, skipping')
+        return
+
+    aggregate(model, output_file, n_tracks)
+    set_aggregated_fingerprint(model, fingerprint)
+
+
+def aggregate_all(n_tracks: Optional[int] = None, force=False):
+    for model in get_models().get_all_offline():
+        update_aggregated(model, n_tracks, force)
+
+
 @click.command('aggregate-all')
 @click.option('-n', '--n-tracks', type=int, help='only process limited amount of tracks')
+@click.option('-f', '--force', is_flag=True, help='aggregate even if nothing changed according to the manifest')
 @with_appcontext
-def aggregate_all_command(n_tracks):
-    aggrdata_dir = Path(current_app.config['AGGRDATA_DIR'])
-    aggrdata_dir.mkdir(parents=True, exist_ok=True)
-
-    models = get_models()
-    for model in models.get_all_offline():
-        aggregate(model, aggrdata_dir / str(model), n_tracks)
+def aggregate_all_command(n_tracks, force):
+    aggregate_all(n_tracks, force)
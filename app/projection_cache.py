@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from flask import current_app
+
+
+class ProjectionCache:
+    """
+    Content-addressed on-disk cache for dynamic projections (t-SNE, UMAP). Entries are compressed .npz files named by
+    the hash of everything that affects the result, so the cache is shared by all the workers. When the total size
+    exceeds max_size, the least recently used entries are removed
+    """
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+
+    @staticmethod
+    def get_key(**params) -> str:
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _get_path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.npz'
+
+    def __contains__(self, key: str):
+        return self._get_path(key).exists()
+
+    def get(self, key: str, track_ids: list[int]) -> Optional[list[np.ndarray]]:
+        """Returns embeddings for each of track_ids (in that order), or None if there is no entry"""
+        path = self._get_path(key)
+        try:
+            with np.load(path) as data:
+                embeddings, lengths, cached_track_ids = data['embeddings'], data['lengths'], data['track_ids']
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+
+        logging.debug(f'Projection cache hit {key}')
+        embeddings = dict(zip(cached_track_ids.tolist(), np.split(embeddings, np.cumsum(lengths)[:-1])))
+        try:
+            return [embeddings[track_id] for track_id in track_ids]
+        except KeyError:
+            return None
+
+    def put(self, key: str, track_ids: list[int], embeddings: list[np.ndarray]):
+        """Writes the entry atomically, so the other workers never read partially written file"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        fp = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False)
+        try:
+            with fp:
+                np.savez_compressed(fp, embeddings=np.vstack(embeddings), lengths=list(map(len, embeddings)),
+                                    track_ids=track_ids)
+            os.replace(fp.name, self._get_path(key))
+        finally:
+            if os.path.exists(fp.name):  # writing failed, the file wasn't moved into the cache
+                os.unlink(fp.name)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.cache_dir.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # removed by other worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            logging.debug(f'Evicted {path} from projection cache')
+
+
+def get_projection_cache() -> ProjectionCache:
+    return ProjectionCache(current_app.config['PROJECTION_CACHE_DIR'], current_app.config['PROJECTION_CACHE_SIZE'])
@@ -4,7 +4,7 @@ from pathlib import Path, PurePosixPath, PureWindowsPath
 
 from flask import Blueprint, Response, current_app, request, url_for
 
-from .database.base import Segment, Track
+from .database.base import Segment, Track, get_segment_resolver
 
 bp = Blueprint('providers', __name__, url_prefix='/audio')
 
@@ -45,11 +45,12 @@ def get_track_url_api(track_id):
 @bp.route('/segment/<int:segment_length>/<int:segment_id>')
 def get_segment_url(segment_length, segment_id):
     segment = Segment.get_by_id(segment_length, segment_id)
-    track_url = get_track_url(segment.track)
+    track = segment.track
+    track_url = get_track_url(track)
     return {
         'url': f'{track_url}{segment.get_url_suffix()}',
-        'text': segment.track.track_metadata.to_text(),
-        'tags': segment.track.track_metadata.tags_to_text()
+        'text': track.track_metadata.to_text(),
+        'tags': track.track_metadata.tags_to_text()
     }
 
 
@@ -62,13 +63,15 @@ def generate_playlist_body(tracks: list[Track]):
 @bp.route('/playlist', methods=['POST'])
 def to_playlist():
     segments = request.json['segments']
-    tracks = []
+    segment_ids = {}
     for segment_str in segments:
         _, segment_length, segment_id = segment_str.split('/')
-        segment = Segment.get_by_id(int(segment_length), int(segment_id))
-        track = segment.track
-        if track not in tracks:
-            tracks.append(track)
+        segment_ids.setdefault(int(segment_length), []).append(int(segment_id))
+
+    track_ids = set()
+    for segment_length, ids in segment_ids.items():
+        track_ids.update(get_segment_resolver(segment_length).resolve(ids)[0].tolist())
 
-    playlist_body = generate_playlist_body(sorted(tracks, key=lambda _track: _track.id))
+    tracks = Track.get_by_ids(list(track_ids)).order_by(Track.id).all()
+    playlist_body = generate_playlist_body(tracks)
     return Response(playlist_body, mimetype='audio/mpegurl')
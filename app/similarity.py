@@ -1,24 +1,54 @@
 import csv
+import logging
 import random
 from pathlib import Path
 from time import time
 from typing import Optional
 
+import numpy as np
 from flask import Blueprint, current_app, request
 
-from .database.base import Segment, Segmentation
+from .database.base import Segment, get_segment_resolver
 from .models import Model, get_models
 
 bp = Blueprint('similarity', __name__)
 
 
+def get_closest_other_artist(index, artist_ids: np.ndarray, ref_segment_id: int, search_k: int = -1,
+                             max_rounds: int = 8) -> Optional[int]:
+    """
+    Returns id of the closest segment that belongs to a different artist than the reference segment. The neighbours
+    are retrieved in windows that double every round, and filtered by artist all at once. If nothing is found within
+    max_rounds, falls back to a random segment of a different artist, so the worst-case latency stays bounded. Returns
+    None if all segments belong to the same artist. Neighbours that artist_ids doesn't cover are skipped, so the index
+    can be newer than the segmentation it was loaded with
+    """
+    ref_artist_id = artist_ids[ref_segment_id]
+    closest_n = 2
+    for _ in range(max_rounds):
+        logging.debug(f'Looking from {closest_n // 2} .. {closest_n}')
+        neighbours = index.get_nns_by_item(ref_segment_id, closest_n + 1, search_k=search_k)
+        candidates = np.array(neighbours[closest_n // 2:], dtype=np.int64)
+        candidates = candidates[candidates < len(artist_ids)]
+        candidates = candidates[artist_ids[candidates] != ref_artist_id]
+        if len(candidates) > 0:
+            return int(candidates[0])
+        closest_n *= 2
+
+    logging.warning(f'No segment of other artist among {closest_n // 2} neighbours of {ref_segment_id}')
+    other_artist_segments = np.flatnonzero(artist_ids != ref_artist_id)
+    if len(other_artist_segments) == 0:
+        return None
+    return int(random.choice(other_artist_segments))
+
+
 def get_segments(strategy: str = 'semirandom', model: Optional[Model] = None):
     length = 3000
 
     if strategy == 'static':
         ref_segment_id = 1000
         segment_choices_id = [2000, 3000, 4000]
-        segment_choices = [Segment.get_by_id(length, segment_id) for segment_id in segment_choices_id]
+        segment_choices = Segment.get_by_ids(length, segment_choices_id)
 
         return {
             'reference': Segment.get_by_id(length, ref_segment_id),
@@ -26,11 +56,6 @@ def get_segments(strategy: str = 'semirandom', model: Optional[Model] = None):
         }
 
     if strategy == 'semirandom':
-        total = Segmentation.get_total_segments(length)
-        ref_segment_id = random.randint(0, total)
-        ref_segment = Segment.get_by_id(length, ref_segment_id)
-        ref_artist = ref_segment.track.track_metadata.artist
-
         if model is None:
             models = []
             for model in get_models().get_combinations():
@@ -40,17 +65,20 @@ def get_segments(strategy: str = 'semirandom', model: Optional[Model] = None):
             model = random.choice(models)
         index = model.get_annoy_index()
 
-        closest_segment = None
-        closest_n = 2
-        while closest_segment is None:
-            print(f'looking from {closest_n//2} .. {closest_n}')
-            for segment_id in index.get_nns_by_item(ref_segment_id, closest_n + 1)[closest_n // 2:]:
-                segment = Segment.get_by_id(length, segment_id)
-                if segment.track.track_metadata.artist != ref_artist:
-                    closest_segment = segment
-            closest_n *= 2
-
-        random_segments = [Segment.get_by_id(length, random.randint(0, total)) for _ in range(2)]
+        # index and segmentation are updated separately, only segments that are in both are used
+        resolver = get_segment_resolver(length)
+        total = min(resolver.total, index.get_n_items())
+        ref_segment_id = random.randrange(total)
+        ref_segment = resolver.get_segment(ref_segment_id)
+
+        closest_segment_id = get_closest_other_artist(index, resolver.artist_ids[:total], ref_segment_id,
+                                                      current_app.config['SIMILARITY_SEARCH_K'],
+                                                      current_app.config['SIMILARITY_MAX_ROUNDS'])
+        if closest_segment_id is None:
+            return None
+        closest_segment = resolver.get_segment(closest_segment_id)
+
+        random_segments = resolver.get_segments([random.randrange(total) for _ in range(2)])
         random_segments.append(closest_segment)
         random.shuffle(random_segments)
 
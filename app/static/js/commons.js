@@ -5,3 +5,62 @@ function createXhr(method, url) {
     xhr.responseType = 'json';
     return xhr;
 }
+
+const TYPED_ARRAYS = {
+    f4: Float32Array,
+    f8: Float64Array,
+    i4: Int32Array,
+    u4: Uint32Array
+};
+
+// decode base64 arrays in the Plotly 'bdata' format that server sends with format=bdata
+let decodeTypedArrays = function (figure) {
+    for (const trace of figure.data) {
+        for (const [key, value] of Object.entries(trace)) {
+            if (value !== null && typeof value === 'object' && 'bdata' in value) {
+                const bytes = Uint8Array.from(atob(value.bdata), c => c.charCodeAt(0));
+                trace[key] = new TYPED_ARRAYS[value.dtype](bytes.buffer);
+            }
+        }
+    }
+    return figure;
+};
+
+const runningJobs = new Set();
+
+// poll background jobs every second until all of them are done, onProgress gets the average progress from 0 to 1
+let waitForJobs = function (jobIds, onDone, onError, onProgress) {
+    jobIds.forEach(jobId => runningJobs.add(jobId));
+    const finish = function () {
+        jobIds.forEach(jobId => runningJobs.delete(jobId));
+    };
+
+    const poll = function () {
+        Promise.all(jobIds.map(jobId => fetch(`/jobs/${jobId}`).then(response => response.json()))).then(states => {
+            const failed = states.find(state => !['pending', 'running', 'done'].includes(state.status));
+            if (failed) {
+                finish();
+                onError(failed);
+            } else if (states.every(state => state.status === 'done')) {
+                finish();
+                onDone();
+            } else {
+                if (onProgress) {
+                    onProgress(states.reduce((sum, state) => sum + state.progress, 0) / states.length);
+                }
+                setTimeout(poll, 1000);
+            }
+        }).catch(error => {
+            finish();
+            onError({status: 'failed', error: error.toString()});
+        });
+    };
+    poll();
+};
+
+// cancel the background jobs that nobody is waiting for anymore
+window.addEventListener('pagehide', function () {
+    for (const jobId of runningJobs) {
+        navigator.sendBeacon(`/jobs/${jobId}/cancel`);
+    }
+});
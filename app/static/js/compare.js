@@ -14,7 +14,9 @@ let loadPlot = function (sides, button) {
             artists: data.getAll('artists'),
             sparse: data.get('sparse'),
             webgl: document.getElementById('check-webgl').checked
-        }
+        },
+        async: true,
+        format: 'bdata'
     };
 
     let ids = [];
@@ -35,14 +37,28 @@ let loadPlot = function (sides, button) {
 
     let request = createXhr('POST', '/plot-advanced');
     request.addEventListener('load', function () {
-        button.disabled = false;
         const response = this.response;
+        if (this.status === 202) {  // slow projections are computed in the background, load plots again when done
+            console.log('Waiting for jobs ' + response.jobs);
+            waitForJobs(response.jobs, function () {
+                loadPlot(sides, button);
+            }, function (state) {
+                console.log('Job ' + state.status + ': ' + state.error);
+                button.disabled = false;
+            }, function (progress) {
+                button.title = Math.round(progress * 100) + '%';
+            });
+            return;
+        }
+
+        button.disabled = false;
         console.dir(response);
 
         for(const side of sides) {  // not sure if better to use the sides, or iterate on returned result
             const plotId = `plot-${side}`;
             const otherPlotId = `plot-${otherSide[side]}`;
 
+            decodeTypedArrays(response.plots[side]);
             let layout = response.plots[side].layout;
             layout['dragmode'] = 'lasso';
             Plotly.newPlot(plotId, response.plots[side].data, layout, {responsive: true});
@@ -62,9 +62,30 @@ let loadPlot = function (animate) {
 
     $.ajax({
         type: 'GET',
-        url: '/plot/' + dataType + '/' + dataset + '/' + architecture + '/' + layer + '/' + nTracks + '/' + projection + '/' + dims[0] + "/" + dims[1],
+        url: '/plot/' + dataType + '/' + dataset + '/' + architecture + '/' + layer + '/' + nTracks + '/' + projection + '/' + dims[0] + "/" + dims[1] + '?async=1&format=bdata',
         dataType: 'json',
-        success: function (data) {
+        success: function (data, textStatus, xhr) {
+            if (xhr.status === 202) {  // slow projection is computed in the background, load plot again when done
+                console.log('Waiting for job ' + data.job);
+                waitForJobs([data.job], function () {
+                    loadPlot(animate);
+                }, function (state) {
+                    console.log('Job ' + state.status + ': ' + state.error);
+                    refreshButton.removeClass('disabled');
+                    refreshButtonSpinner.hide();
+                    bootbox.alert({
+                        title: "Error",
+                        message: 'Projection ' + state.status,
+                        backdrop: true,
+                        centerVertical: true,
+                        size: 'small'
+                    });
+                }, function (progress) {
+                    refreshButtonSpinner.attr('title', Math.round(progress * 100) + '%');
+                });
+                return;
+            }
+
             console.log('Got plot data:');
             console.dir(data);
             refreshButton.removeClass('disabled');
@@ -78,6 +99,8 @@ let loadPlot = function (animate) {
             localStorage.setItem('projection', projection);
             saveDims(dims);
 
+            decodeTypedArrays(data);
+
             // TODO: set animate appropriately
             animate = false;
 
@@ -31,5 +31,7 @@ def compare():
 @bp.route('/similarity')
 def explore():
     segments = get_segments()
+    if segments is None:
+        return 'No segments of different artists to compare', 404
     closest_idx = segments['choices'].index(segments['closest']) + 1
     return render_template('similarity.html', segments=segments, closest_idx=closest_idx)
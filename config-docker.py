@@ -11,6 +11,8 @@ LOGGING_LEVEL = 'INFO'
 # Annoy
 ANNOY_DISTANCE = 'angular'
 ANNOY_TREES = 16
+ANNOY_PRELOAD = True  # load all indexes on app start, so they are shared by uWSGI workers (keep lazy-apps disabled)
+INDEX_WORKERS = 2  # number of indexes that index-all-embeddings builds in parallel
 
 # Models
 MODELS_FILE = 'models.yaml'
@@ -19,6 +21,12 @@ MODELS_FILE = 'models.yaml'
 ROOT_DIR = '/data/'
 INDEX_DIR = f'{ROOT_DIR}/annoy'  # directory for indexed embeddings
 AGGRDATA_DIR = f'{ROOT_DIR}/aggrdata'  # directory for aggregated embeddings
+EMBEDDINGS_READ_WORKERS = 8  # threads that load embeddings files, more of them help on network storage
+EMBEDDINGS_READ_AHEAD = 32  # max number of embeddings files that are loaded ahead of processing
+
+# Similarity
+SIMILARITY_SEARCH_K = -1  # search_k for annoy when looking for the closest segment of other artist (-1 is default)
+SIMILARITY_MAX_ROUNDS = 8  # number of times the search window is doubled before falling back to a random segment
 
 # Constants
 SEGMENT_PRECISION = 1  # number of digits to show after period for seconds for url hash
@@ -26,23 +34,42 @@ SEGMENT_PRECISION = 1  # number of digits to show after period for seconds for u
 # Database
 SQLALCHEMY_DATABASE_URI = f'sqlite:///{ROOT_DIR}/db.sqlite'
 SQLALCHEMY_TRACK_MODIFICATIONS = False  # to suppress warnings about deprecated functionality in sqlalchemy
+STAMPS_DIR = f'{ROOT_DIR}/stamps'  # commands mark database changes here, so that workers reload the data they cache
 
 # Number of items that are committed at a time: higher number speeds up processing but if something goes wrong,
 # more data will be lost
 DB_COMMIT_BATCH_SIZE = 1000
 
+# Extraction
+EXTRACT_DECODE_WORKERS = 4  # number of processes that decode audio and compute melspecs
+EXTRACT_WRITE_WORKERS = 1  # number of threads that save embeddings
+EXTRACT_BATCH_PATCHES = 512  # patches of several tracks are passed to the models at once until there are that many
+EXTRACT_MAX_PATCHES = 512  # longer inputs are passed to the models in chunks, so long tracks don't run out of memory
+EXTRACT_QUEUE_SIZE = 16  # max number of tracks waiting between the stages
+ID3_WORKERS = 4  # number of processes that parse ID3 tags in load-id3-metadata
+
 # Audio
 AUDIO_PROVIDER = 'jamendo'  # can be 'jamendo' for mtg-jamendo-dataset, or 'local' for in-house collection
 
 # Jamendo - ignore if not using Jamendo
 JAMENDO_CLIENT_ID = os.environ.get("JAMENDO_CLIENT_ID")
+JAMENDO_API_URL = 'https://api.jamendo.com/v3.0'  # can point to a local stand-in server for testing
 JAMENDO_BATCH_SIZE = 100  # number of tracks to include in one API call to Jamendo when populating the metadata
+JAMENDO_WORKERS = 4  # max number of API calls in flight when populating the metadata
+JAMENDO_RATE_LIMIT = 5  # max number of API calls per second
 
 # Experiments results
 EXPERIMENTS_DIR = f'{ROOT_DIR}/results'  # where to store similarity results
 
 # Plots
 PCA_DIMS = 10  # number of PCA dimensions that are used for tsne and umap
+PROJECTION_CACHE_DIR = f'{ROOT_DIR}/projections'  # cache for tsne and umap results, shared by all workers
+PROJECTION_CACHE_SIZE = 2**30  # in bytes, least recently used projections are removed when it is exceeded
+PROJECTION_MODELS_DIR = f'{ROOT_DIR}/projection-models'  # tsne and umap fitted with fit-projections
+PROJECTION_FIT_SAMPLE = 100000  # number of segments that tsne and umap are fitted on
+JOBS_DIR = f'{ROOT_DIR}/jobs'  # state of background projection jobs, shared by all workers
+JOBS_WORKERS = 2  # number of processes per worker that compute projections in the background
+PLOT_COLUMNAR_THRESHOLD = 200  # with more tracks, segments are plotted as one trace instead of one trace per track
 
 # Flask-Caching related configs
 CACHE_TYPE = 'SimpleCache'